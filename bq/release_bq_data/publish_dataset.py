@@ -20,12 +20,17 @@ import settings
 import argparse
 import json
 import time
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from google.cloud import bigquery
 from google.cloud.bigquery import SchemaField
 from google.cloud.exceptions import NotFound
 from google.api_core.exceptions import NotFound, BadRequest
 from utilities.logging_config import successlogger, progresslogger, errlogger
 
+POLL_INTERVAL = 2 # Seconds between polls of running table copy jobs
+VIEW_THREADS = 8 # Maximum number of views that are created concurrently
+
 '''
 ----------------------------------------------------------------------------------------------
 Create the target dataset:
@@ -62,58 +67,82 @@ def bq_dataset_exists(client, project , target_dataset):
         return False
 
 
-def copy_table(client, args,  table_id):
+# Start a job that copies a table. Returns the job
+def start_table_copy(client, args, table_id):
+    src_table_id = f'{args.src_project}.{args.src_dataset}.{table_id}'
+    trg_table_id = f'{args.trg_project}.{args.trg_dataset}.{table_id}'
+
+    job_config = bigquery.CopyJobConfig()
+    job_config.operation_type = 'COPY'
+    job_config.write_disposition = 'WRITE_TRUNCATE'
 
-    # try:
-    #     table = client.get_table(f'{args.trg_project}.{args.trg_dataset}.{table_id}')
-    #     progresslogger.info(f'Table {table} already exists.')
-    # except:
-    if True:
-        src_table_id = f'{args.src_project}.{args.src_dataset}.{table_id}'
-        trg_table_id = f'{args.trg_project}.{args.trg_dataset}.{table_id}'
+    # Construct and start a copy job.
+    return client.copy_table(
+        src_table_id,
+        trg_table_id,
+        # Must match the source and destination tables location.
+        location="US",
+        job_config=job_config,
+    )  # Make an API request.
 
-        # Construct a BigQuery client object.
-        client = bigquery.Client()
-        job_config = bigquery.CopyJobConfig()
-        job_config.operation_type = 'COPY'
-        job_config.write_disposition = 'WRITE_TRUNCATE'
 
-        # Construct and run a copy job.
-        job = client.copy_table(
-            src_table_id,
-            trg_table_id,
-            # Must match the source and destination tables location.
-            location="US",
-            job_config=job_config,
-        )  # Make an API request.
+# Complete the copy of a table after its copy job is done
+def finish_table_copy(client, args, table_id, job):
+    job.result()  # Raises if the job failed
+    progresslogger.info("Copied table {}.{}.{} to {}.{}.{}".format(args.src_project, args.src_dataset, table_id,
+                                                                 args.trg_project, args.trg_dataset, table_id))
 
-        job.result()  # Wait for the job to complete.
+    if table_id == 'dicom_derived_all':
+        dataset_ref = bigquery.DatasetReference(args.trg_project, args.trg_dataset)
+        table_ref = dataset_ref.table(table_id)
+        table = client.get_table(table_ref)  # API request
+        table.description = "DEPRECATED: This table will likely be removed in a future IDC version"
+        table = client.update_table(table, ["description"])  # API request
 
-        progresslogger.info("Copied table {} to {}".format(src_table_id, trg_table_id))
 
-        if table_id == 'dicom_derived_all':
-            dataset_ref = bigquery.DatasetReference(args.trg_project, args.trg_dataset)
-            table_ref = dataset_ref.table(table_id)
-            table = client.get_table(table_ref)  # API request
-            table.description = "DEPRECATED: This table will likely be removed in a future IDC version"
-            table = client.update_table(table, ["description"])  # API request
+def copy_table(client, args,  table_id):
+    job = start_table_copy(client, args, table_id)
+    job.result()  # Wait for the job to complete.
+    finish_table_copy(client, args, table_id, job)
+    return
 
-        return
 
+# Copy tables concurrently. All the copy jobs are submitted, then polled together until they are done.
+# Raises if any copy failed, after all the jobs are done, so that views aren't created over missing tables.
+def copy_tables(client, args, table_ids):
+    jobs = {table_id: start_table_copy(client, args, table_id) for table_id in table_ids}
+    progresslogger.info(f'Started {len(jobs)} table copy jobs')
+    failures = []
+    while jobs:
+        time.sleep(POLL_INTERVAL)
+        for table_id, job in list(jobs.items()):
+            try:
+                if not job.done():  # Makes an API request
+                    continue
+                del jobs[table_id]
+                finish_table_copy(client, args, table_id, job)
+            except Exception as exc:
+                jobs.pop(table_id, None)
+                errlogger.error(f'Copy of table {table_id} failed: {exc}')
+                failures.append(table_id)
+    if failures:
+        raise RuntimeError(f'Copy of tables {failures} failed')
+    return
 
 
-def copy_view(client, args, view_id):
+def copy_view(client, args, view_id, src_view=None):
     try:
         try:
-            view = client.get_table(f'{args.trg_project}.{args.trg_dataset}.{view_id}')
-            progresslogger.info(f'View {view} already exists.')
+            trg_view = client.get_table(f'{args.trg_project}.{args.trg_dataset}.{view_id}')
+            progresslogger.info(f'View {trg_view} already exists.')
             client.delete_table(f'{args.trg_project}.{args.trg_dataset}.{view_id}', not_found_ok=True)
-            progresslogger.info(f'Deleted {view}.')
+            progresslogger.info(f'Deleted {trg_view}.')
         except:
             progresslogger.info(f'View {view_id} does not exist.')
 
         finally:
-            view = client.get_table(f'{args.src_project}.{args.src_dataset}.{view_id}')
+            view = src_view if src_view is not None else \
+                client.get_table(f'{args.src_project}.{args.src_dataset}.{view_id}')
 
             new_view = bigquery.Table(f'{args.trg_project}.{args.trg_dataset}.{view_id}')
             new_view.view_query = view.view_query.replace(args.src_project,args.pub_project). \
@@ -137,10 +166,65 @@ def copy_view(client, args, view_id):
             except BadRequest as exc:
                 errlogger.error(f'{exc}')
     except Exception as exc:
-        errlogger.error((f'{exc}'))
-        progresslogger.info((f'Really done'))
+        errlogger.error(f'Copy of view {view_id} failed: {exc}')
+        raise
     return
 
+# Get the views in view_ids that a view references
+def view_dependencies(args, view, view_ids):
+    references = set(re.findall(rf'\b{re.escape(args.src_dataset)}\.(\w+)', view.view_query))
+    return (references & set(view_ids)) - {view.table_id}
+
+
+# Copy views concurrently, in dependency order. A view is created as soon as all the views
+# that it references have been created, so independent views are created in parallel.
+# A view that references a view that failed is not created.
+# Raises if any view copy raised, after all the views have been attempted.
+def copy_views(client, args, view_ids):
+    failures = []
+    with ThreadPoolExecutor(max_workers=VIEW_THREADS) as executor:
+        views = dict(zip(view_ids, executor.map(
+            lambda view_id: client.get_table(f'{args.src_project}.{args.src_dataset}.{view_id}'), view_ids)))
+        dependencies = {view_id: view_dependencies(args, view, view_ids) for view_id, view in views.items()}
+        done = set()
+        running = {}
+        while len(done) < len(views):
+            # Skipping a view can make the views that reference it ready, so rescan until nothing is skipped
+            skipped = True
+            while skipped:
+                skipped = False
+                for view_id in views:
+                    if view_id not in done and view_id not in running.values() and dependencies[view_id] <= done:
+                        if dependencies[view_id] & set(failures):
+                            errlogger.error(f'Skipped view {view_id}: it references failed views {dependencies[view_id] & set(failures)}')
+                            failures.append(view_id)
+                            done.add(view_id)
+                            skipped = True
+                        else:
+                            running[executor.submit(copy_view, client, args, view_id, views[view_id])] = view_id
+            if len(done) == len(views):
+                break
+            if not running:
+                # The remaining views reference each other
+                remaining = [view_id for view_id in views if view_id not in done]
+                errlogger.error(f'Circular view dependencies among {remaining}')
+                for view_id in remaining:
+                    try:
+                        copy_view(client, args, view_id, views[view_id])
+                    except Exception:
+                        failures.append(view_id)
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                view_id = running.pop(future)
+                if future.exception():
+                    failures.append(view_id)
+                done.add(view_id)
+    if failures:
+        raise RuntimeError(f'Copy of views {failures} failed')
+    return
+
+
 def publish_dataset(args, table_ids={}):
     client = bigquery.Client()
     # client = bigquery.Client(project=args.trg_project)
@@ -160,12 +244,8 @@ def publish_dataset(args, table_ids={}):
     if not table_ids:
         table_ids = {table.table_id: table.table_type for table in client.list_tables(f'{args.src_project}.{args.src_dataset}')}
     # Create tables first
-    for table_id in table_ids:
-        if table_ids[table_id] == 'TABLE':
-            copy_table(client, args, table_id)
+    copy_tables(client, args, [table_id for table_id in table_ids if table_ids[table_id] == 'TABLE'])
 
-    for table_id in table_ids:
-        if table_ids[table_id] == 'VIEW':
-            copy_view(client, args, table_id)
+    copy_views(client, args, [table_id for table_id in table_ids if table_ids[table_id] == 'VIEW'])
 
     return
@@ -19,7 +19,8 @@ import json
 import argparse
 from collection_list_crdcobj import collection_list
 from utilities.logging_config import successlogger, progresslogger, errlogger
-from idc.models import Base, Version, Collection, Patient, Study, Series, Instance, All_Collections
+from utilities.sqlalchemy_helpers import eager_hierarchy
+from idc.models import Base, Version, Collection, Patient, Study, Series, Instance, All_Collections, series_instance
 from google.cloud import storage
 from sqlalchemy.orm import Session
 import settings
@@ -29,6 +30,11 @@ def gen_series_object(args, sess, collection, patient, study, series):
     level = "Series"
     if not args.dst_bucket.blob(f"{series.uuid}.idc").exists():
         print(f'\t\t\t{level} {series.uuid} started')
+        # Get just the columns of the series' instances that the manifest needs, rather than
+        # loading the Instance objects
+        instances = sess.query(Instance.sop_instance_uid, Instance.uuid). \
+            join(series_instance, series_instance.c.instance_uuid == Instance.uuid). \
+            filter(series_instance.c.series_uuid == series.uuid).all()
         # Create a combined "folder" and "bundle" blob
         contents = {
             'encoding_version': '1.0',
@@ -46,7 +52,7 @@ def gen_series_object(args, sess, collection, patient, study, series):
                         {
                             'name': i.sop_instance_uid,
                             'drs_uri': f'drs://dg.4DFC/{i.uuid}'
-                        } for i in series.instances
+                        } for i in instances
                     ],
                 },
                 {
@@ -121,7 +127,10 @@ def gen_all(args):
 
     with Session(sql_engine) as sess:
         for collection_id in collection_list:
-            collections = sess.query(Collection).filter(Collection.collection_id == collection_id)
+            # Load each collection's hierarchy down to its series in a query per level. A series'
+            # instances are queried when its manifest is generated.
+            collections = sess.query(Collection).options(eager_hierarchy(Collection, 3)). \
+                filter(Collection.collection_id == collection_id)
             for collection in collections:
                 gen_collection_object(args, sess, collection)
 
@@ -32,6 +32,7 @@ if __name__ == '__main__':
     parser.add_argument('--dst_bucket', default='sjo', help='Bucket into which to copy blobs')
     parser.add_argument('--batch', default=100)
     parser.add_argument('--processes', default=16)
+    parser.add_argument('--threads', default=16, help='Number of concurrent copies per process')
     args = parser.parse_args()
     args.id = 0 # Default process ID
 
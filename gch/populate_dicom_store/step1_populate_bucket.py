@@ -25,13 +25,12 @@
 import sys
 import argparse
 from googleapiclient import discovery
-from google.api_core.exceptions import Conflict, TooManyRequests, ServiceUnavailable, NotFound
+from google.api_core.exceptions import Conflict
 from step2_import_bucket import import_buckets
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.copy_engine import copy_blobs, dst_blob_name, COPY_THREADS
 import settings
 from google.cloud import storage, bigquery
-from multiprocessing import Process, Queue
-from time import  sleep
 
 
 def get_gch_client():
@@ -101,80 +100,12 @@ def build_dones_table(args):
     )
     return table.num_rows
 
-# Populate a bucket with instances to be inserted in the DICOM store
-def copy_some_instances(args, client, uids, n):
-    try:
-        done = 0
-        dst_bucket = client.bucket(args.staging_bucket)
-        for row in uids:
-            blob_id = row['blob_id']
-            BUCKET_TRIES = 10
-            for i in range(BUCKET_TRIES):
-                try:
-                    src_bucket = client.bucket(row['bucket'])
-                    src_blob = src_bucket.blob(blob_id)
-                    break
-                except AttributeError as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Trying to create bucket: {exc}; attempt {i}\n")
-                    sleep(1)
-                except TooManyRequests as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Too many requests: {repr(exc)};  {exc}\n")
-                    sleep(1)
-                except ServiceUnavailable as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Service unavailable: {repr(exc)};  {exc}\n")
-                    sleep(1)
-            if i == BUCKET_TRIES:
-                errlogger.error(
-                    f"p{args.id}: Failed to create bucket)")
-                break
-
-            dst_blob = dst_bucket.blob(blob_id)
-            rewrite_token = False
-            while True:
-                try:
-                    rewrite_token, bytes_rewritten, total_bytes = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        successlogger.info(f'{blob_id}')
-                        break
-                except AttributeError as exc:
-                    errlogger.warning(
-                        f"p{args.id}: Trying to create bucket: {exc}; attempt {i}\n")
-                    sleep(1)
-                except TooManyRequests as exc0:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Too many requests: {repr(exc0)};  {exc0}")
-                    sleep(1)
-                except ServiceUnavailable as exc0:
-                    errlogger.warning(
-                        f"p{args.id}: Blob: Service unavailable: {repr(exc0)};  {exc0}")
-                    sleep(1)
-                except NotFound as exc:
-                    errlogger.error(
-                        f"p{args.id}: Blob: Source blob {row['bucket']}/{blob_id} not found")
-                    break
-
-                    break
-            done += 1
-        progresslogger.info(f"p{args.id}: {done + n}of{len(uids) + n}")
-    except Exception as exc2:
-        # breakpoint()
-        errlogger.exception(f'p{args.id}: copy: exception type: {repr(exc2)}; {exc2}; row = {row}')
-    return
-
-def worker(input, args):
-    client = storage.Client()
-    for uids, n in iter(input.get, 'STOP'):
-        try:
-            copy_some_instances(args, client, uids, n)
-        except Exception as exc3:
-            # breakpoint()
-            errlogger.error(f'p{args.id}: worker, exception type: {repr(exc3)} exception {exc3}')
-    return
+# Generate the (src, dst) pairs of the instances to be inserted in the DICOM store
+def get_pairs(args, destination):
+    client = bigquery.Client()
+    for page in client.list_rows(destination, page_size=int(args.batch)).pages:
+        for row in page:
+            yield f'gs://{row.bucket}/{row.blob_id}', f'gs://{args.staging_bucket}/{row.blob_id}'
 
 
 def populate_staging_bucket(args):
@@ -235,32 +166,8 @@ def populate_staging_bucket(args):
 
     progresslogger.info(f'p{0}: {dones} of {dones+destination.num_rows} completed')
 
-    num_processes = args.processes
-    processes = []
-    task_queue = Queue()
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
-        processes[-1].start()
-
-   # Populate the staging bucket
-    n = dones
-    for page in client.list_rows(destination, page_size=args.batch).pages:
-        uuids = [{'blob_id':row.blob_id, 'bucket':row.bucket} \
-            for row in page]
-        task_queue.put((uuids,n))
-        n += args.batch
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-
-    # Wait for process to terminate
-    for process in processes:
-        progresslogger.info(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
+    # Previously copied blobs were excluded by the query
+    copy_blobs(args, get_pairs(args, destination), key=dst_blob_name)
 
 
 def populate_bucket(args):
@@ -271,6 +178,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--client', default=storage.Client())
     parser.add_argument('--processes', default=1)
+    parser.add_argument('--threads', default=COPY_THREADS, help='Number of concurrent copies per process')
     parser.add_argument('--batch', default=1000)
     parser.add_argument('--dones_table_id', default='idc-dev-etl.whc_dev.step1_dones', help='BQ table from which to import dones')
     parser.add_argument('--log_dir', default=settings.LOG_DIR)
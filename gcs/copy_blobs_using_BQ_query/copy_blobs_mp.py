@@ -19,9 +19,8 @@ import argparse
 import logging
 from logging import INFO
 from google.cloud import bigquery, storage
-import time
-from multiprocessing import Process, Queue
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.copy_engine import copy_blobs, get_dones
 
 # Copy the blobs that are new to a version from dev pre-staging buckets
 # to dev staging buckets.
@@ -38,49 +37,11 @@ def get_urls(args, query):
     destination = client.get_table(destination)
     return destination
 
-TRIES = 3
-
-def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n):
-    for blob_name in blob_names:
-        src_blob = src_bucket.blob(blob_name)
-        dst_blob = dst_bucket.blob(blob_name)
-        retries = 0
-        while True:
-            try:
-                rewrite_token = False
-                while True:
-                    rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        break
-                successlogger.info(f'{blob_name}')
-                break
-            except Exception as exc:
-                if retries == TRIES:
-                    errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
-                    break
-            time.sleep(retries)
-            retries += 1
-
-    progresslogger.info('p%s Copied blobs %s:%s ', args.id, n, n+len(blob_names)-1)
-
-
-def worker(input, args, dones):
-    # proglogger.info('p%s: Worker starting: args: %s', args.id, args )
-    # print(f'p{args.id}: Worker starting: args: {args}')
-
-    RETRIES=3
-
-    client = storage.Client()
-    src_bucket = storage.Bucket(client, args.src_bucket)
-    dst_bucket = storage.Bucket(client, args.dst_bucket)
-    for blob_names, n in iter(input.get, 'STOP'):
-        blob_names_todo = set(blob_names) - dones
-        if blob_names_todo:
-            copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n)
-        else:
-            progresslogger.info(f'p{args.id}: Blobs {n}:{n+len(blob_names)-1} previously copied')
+def get_pairs(args, destination):
+    bq_client = bigquery.Client()
+    for page in bq_client.list_rows(destination, page_size=int(args.batch)).pages:
+        for row in page:
+            yield f'gs://{args.src_bucket}/{row.blob}', f'gs://{args.dst_bucket}/{row.blob}'
 
 # Copy the blobs resulting from the BQ query
 # args must have the following components:
@@ -89,48 +50,12 @@ def worker(input, args, dones):
 # dst_bucket: Bucket to which to copy)
 # batch: Batch sizw to workers)
 # processes: Number of processes to run)
+# threads: Number of concurrent copies per process)
 
 def copy_all_blobs(args, query):
-    bq_client = bigquery.Client()
     destination = get_urls(args, query)
-
-    num_processes = args.processes
-    processes = []
-    # Create a pair of queue for each process
-
-    task_queue = Queue()
-
-    strt = time.time()
-    dones = set(open(f'{successlogger.handlers[0].baseFilename}').read().splitlines())
-
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args, dones)))
-        processes[-1].start()
-
-    # Distribute the work across the task_queues
-    n = 0
-    for page in bq_client.list_rows(destination, page_size=args.batch).pages:
-        urls = [row.blob for row in page]
-        task_queue.put((urls, n))
-        # print(f'Queued {n}:{n+args.batch-1}')
-        n += page.num_items
-    print('Primary work distribution complete; {} blobs'.format(n))
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-
-
-    # Wait for process to terminate
-    for process in processes:
-        print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
-    delta = time.time() - strt
-    rate = (n)/delta
+    dones = get_dones()
+    copy_blobs(args, get_pairs(args, destination), dones)
 
 
 # if __name__ == '__main__':
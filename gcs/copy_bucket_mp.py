@@ -30,10 +30,8 @@ import os
 # successlogger = logging.getLogger('root.success')
 # errlogger = logging.getLogger('root.err')
 from utilities.logging_config import successlogger, progresslogger, errlogger
-import time
-from multiprocessing import Process, Queue
-from google.cloud import storage, bigquery
-from google.api_core.exceptions import ServiceUnavailable, GoogleAPICallError
+from utilities.copy_engine import copy_blobs
+from utilities.bucket_listing import list_bucket
 
 from python_settings import settings
 import settings as etl_settings
@@ -42,110 +40,23 @@ if not settings.configured:
     settings.configure(etl_settings)
 assert settings.configured
 
-TRIES = 3
-
-def copy_instances(args, client, src_bucket, dst_bucket, blob_names, n):
-    for blob_name in blob_names:
-        src_blob = src_bucket.blob(blob_name)
-        dst_blob = dst_bucket.blob(blob_name)
-        retries = 0
-        while True:
-            try:
-                rewrite_token = False
-                while True:
-                    rewrite_token, bytes_rewritten, bytes_to_rewrite = dst_blob.rewrite(
-                        src_blob, token=rewrite_token
-                    )
-                    if not rewrite_token:
-                        break
-                successlogger.info(f'{blob_name}')
-                break
-            except Exception as exc:
-                if retries == TRIES:
-                    errlogger.error('p%s: %s/%s copy failed\n   %s', args.id, args.src_bucket, blob_name, exc)
-                    break
-            time.sleep(retries)
-            retries += 1
-
-    progresslogger.info('p%s Copied blobs %s:%s ', args.id, n, n+len(blob_names)-1)
-
-
-def worker(input, args, dones):
-    # proglogger.info('p%s: Worker starting: args: %s', args.id, args )
-    # print(f'p{args.id}: Worker starting: args: {args}')
-
-    RETRIES=3
-
-    client = storage.Client()
-    src_bucket = storage.Bucket(client, args.src_bucket)
-    dst_bucket = storage.Bucket(client, args.dst_bucket)
-    for blob_names, n in iter(input.get, 'STOP'):
-        try:
-            blob_names_todo = blob_names - dones
-            if blob_names_todo:
-                copy_instances(args, client, src_bucket, dst_bucket, blob_names_todo, n)
-            else:
-                progresslogger.info(f'p{args.id}: Blobs {n}:{n+len(blob_names)-1} previously copied')
-        except Exception as exc:
-            errlogger.error(f'p{args.id}: Error {exc}')
 
+def get_pairs(args):
+    for page in list_bucket(args.src_bucket, page_size=int(args.batch)):
+        for blob in page:
+            yield f'gs://{args.src_bucket}/{blob.name}', f'gs://{args.dst_bucket}/{blob.name}'
 
 
 def copy_all_instances(args, dones):
-    client = storage.Client()
-    src_bucket = storage.Bucket(client, args.src_bucket)
-    n=len(dones)
-
     progresslogger.info(f"{len(dones)} blobs previously copied")
 
     progresslogger.info(f'Copying bucket {args.src_bucket} to {args.dst_bucket}, ')
 
-    num_processes = args.processes
-    processes = []
-    task_queue = Queue()
-
-    strt = time.time()
-
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args, dones)))
-        processes[-1].start()
-
-    # Distribute the work across the task_queues
-    n = 0
-    iterator = client.list_blobs(src_bucket,  page_size=args.batch)
-    for page in iterator.pages:
-        if page.num_items:
-            blobs = set([blob.name for blob in page])
-            # blobs = blobs - dones
-            task_queue.put((blobs, n))
-            # print(f'Queued {n}:{n+len(blobs)-1}')
-        else:
-            break
-        n += page.num_items
-    progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-        task_queue.put('STOP')
-
-
-    # Wait for process to terminate
-    for process in processes:
-        print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
-    delta = time.time() - strt
-    rate = (n)/delta
-    errors = open(errlogger.handlers[0].baseFilename).read().splitlines()
-    error_buckets = set([error.split(' ')[1].split('/')[0] for error in errors])
-    if src_bucket in error_buckets:
+    totals = copy_blobs(args, get_pairs(args), dones)
+    if totals['failed']:
         print(f'Bucket {args.src_bucket} had errors')
     else:
-        progresslogger.info(f'Completed bucket {args.src_bucket}, {rate} instances/sec, {num_processes} processes')
+        progresslogger.info(f'Completed bucket {args.src_bucket}')
 
 
 # if __name__ == '__main__':
@@ -155,6 +66,7 @@ def copy_all_instances(args, dones):
 #     parser.add_argument('--dst_project', default='idc-pdp-staging')
 #     parser.add_argument('--dst_bucket', default=f'idc-open-pdp-staging')
 #     parser.add_argument('--processes', default=1, help="Number of concurrent processes")
+#     parser.add_argument('--threads', default=COPY_THREADS, help="Number of concurrent copies per process")
 #     parser.add_argument('--batch', default=100, help='Size of batch assigned to each process')
 #     parser.add_argument('--log_dir', default=f'/mnt/disks/idc-etl/logs/copy_bucket_mp')
 #
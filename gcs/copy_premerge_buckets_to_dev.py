@@ -23,6 +23,7 @@
 import os
 import argparse
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.copy_engine import get_dones, COPY_THREADS
 
 import settings
 from google.cloud import storage, bigquery
@@ -63,12 +64,8 @@ def copy_premerge_buckets(args):
     client = storage.Client()
     bucket_data= get_collection_groups()
     preview_copies(args, client, bucket_data)
-    try:
-        # Create a set of previously copied blobs
-        # dones = set(open(f'{args.log_dir}/{args.src_bucket}_success.log').read().splitlines())
-        dones = set(open(successlogger.handlers[0].baseFilename).read().splitlines())
-    except:
-        dones = set([])
+    # Get the previously copied blobs
+    dones = get_dones()
 
     for collection_id in sorted(list(bucket_data.keys())):
         if client.bucket(f'idc_v{args.version}_tcia_{collection_id}').exists():
@@ -88,6 +85,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--version', default=settings.CURRENT_VERSION, help='Version to work on')
     parser.add_argument('--processes', default=32, help="Number of concurrent processes")
+    parser.add_argument('--threads', default=COPY_THREADS, help="Number of concurrent copies per process")
     parser.add_argument('--batch', default=100, help='Size of batch assigned to each process')
     args = parser.parse_args()
     args.id = 0 # Default process ID
@@ -28,11 +28,7 @@ import logging
 # errlogger = logging.getLogger('root.err')
 
 from utilities.logging_config import successlogger, progresslogger, errlogger
-
-import time
-from multiprocessing import Process, Queue
-from google.cloud import storage
-from google.api_core.exceptions import ServiceUnavailable, NotFound
+from utilities.delete_engine import delete_all_blobs
 
 from python_settings import settings
 import settings as etl_settings
@@ -42,80 +38,7 @@ if not settings.configured:
 assert settings.configured
 
 
-def delete_instances(args, client, bucket, blobs, n):
-    TRIES = 3
-    for i in range(TRIES):
-        try:
-            with client.batch():
-                for blob in blobs:
-                    bucket.blob(blob[0], generation=blob[1]).delete()
-            successlogger.info('p%s Delete %s blobs %s:%s ', args.id, args.bucket, n, n+len(blobs)-1)
-            break
-        except ServiceUnavailable:
-            errlogger.error('p%s Delete %s blobs %s:%s failed', args.id, args.bucket, n, n+len(blobs)-1)
-        except Exception as exc:
-            errlogger.error('p%s Exception %s %s:%s', args.id, exc, n, n+len(blobs)-1)
-        except NotFound:
-            errlogger.error('p%s Delete %s blobs %s:%s failed, not found', args.id, args.bucket, n, n+len(blobs)-1)
-            break
-
-
-def worker(input, args):
-    client = storage.Client()
-    bucket = storage.Bucket(client, args.bucket)
-    for blobs, n in iter(input.get, 'STOP'):
-        delete_instances(args, client, bucket, blobs, n)
-
-
+# Delete all the blobs in args.bucket
 def del_all_instances(args):
-    bucket = args.bucket
-    client = storage.Client()
-    bucket = storage.Bucket(client, args.bucket)
-
     progresslogger.info(f'Deleting bucket {args.bucket}')
-
-    num_processes = args.processes
-    processes = []
-
-    task_queue = Queue()
-
-    strt = time.time()
-
-    # Start worker processes
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
-        processes[-1].start()
-
-
-    # Distribute the work across the task_queues
-    n = 0
-    page_token = ""
-    # iterator = client.list_blobs(bucket, page_token=page_token, max_results=args.batch)
-    iterator = client.list_blobs(bucket, versions=True, page_token=page_token, page_size=args.batch)
-    for page in iterator.pages:
-        blobs = [[blob.name, blob.generation] for blob in page]
-        if len(blobs) == 0:
-            break
-        task_queue.put((blobs, n))
-        # print(f'Queued {n}:{n+len(blobs)-1}')
-        # task_queue.put((page, n))
-
-        n += page.num_items
-    progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-
-
-    # Wait for process to terminate
-    for process in processes:
-        # print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
-
-    delta = time.time() - strt
-    rate = (n)/delta
-    progresslogger.info(f'Completed bucket {args.bucket}, {rate} instances/sec, {num_processes} processes')
-
+    return delete_all_blobs(args)
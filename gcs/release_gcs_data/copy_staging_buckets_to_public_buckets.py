@@ -18,20 +18,19 @@
 import argparse
 from gcs.copy_bucket_mp import copy_all_instances
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.copy_engine import get_dones, COPY_THREADS
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--processes', default=1, help="Number of concurrent processes")
+    parser.add_argument('--threads', default=COPY_THREADS, help="Number of concurrent copies per process")
     parser.add_argument('--batch', default=100, help='Size of batch assigned to each process')
     parser.add_argument('--log_dir', default=f'/mnt/disks/idc-etl/logs/copy_bucket_mp')
 
     args = parser.parse_args()
 
-    try:
-        # Create a set of previously copied blobs
-        dones = set(open(successlogger.handlers[0].baseFilename).read().splitlines())
-    except:
-        dones = set([])
+    # Get the previously copied blobs
+    dones = get_dones()
 
     args.src_bucket = 'public-datasets-idc-staging'
     args.dst_bucket = 'public-datasets-idc'
@@ -29,6 +29,8 @@ from base64 import b64decode
 import logging
 from logging import INFO, ERROR
 from utilities.bq_helpers import load_BQ_from_json, load_BQ_from_CSV
+from utilities.done_set import DoneSet
+from utilities.bucket_listing import list_bucket
 
 
 prestageblobs = logging.getLogger('root.prestageblobs')
@@ -134,7 +136,7 @@ def get_found_blobs_in_bucket(args):
     bucket = client.bucket(args.bucket)
     page_token = ""
     # Get the completed series
-    done_series = open(f'{foundseries.handlers[0].baseFilename}').read().splitlines()
+    done_series = DoneSet.from_log(foundseries.handlers[0].baseFilename)
 
     # Start worker processes
     num_processes = args.processes
@@ -149,10 +151,7 @@ def get_found_blobs_in_bucket(args):
     # iterator = client.list_blobs(bucket, page_token=page_token, max_results=args.batch)
     n = 0
     with open(args.found_blobs, 'w') as f:
-        series_iterator = client.list_blobs(bucket, versions=False, page_size=args.batch, \
-                                            prefix='', delimiter='/')
-        for page in series_iterator.pages:
-            prefixes = [prefix for prefix in page.prefixes]
+        for prefixes in list_bucket(args.bucket, page_size=args.batch, delimiter='/', client=client):
             task_queue.put((bucket, prefixes, n))
             # for prefix in page.prefixes:
             #     instance_iterator = client.list_blobs(bucket, versions=False, page_token=page_token, page_size=args.batch, \
@@ -181,7 +180,7 @@ def get_prestaging_blobs_in_bucket(args):
     bucket = client.bucket(args.bucket)
 
     # Get the completed series
-    done_series = open(f'{prestageseries.handlers[0].baseFilename}').read().splitlines()
+    done_series = DoneSet.from_log(prestageseries.handlers[0].baseFilename)
 
     # Start worker processes
     num_processes = args.processes
@@ -196,10 +195,7 @@ def get_prestaging_blobs_in_bucket(args):
     for bucket in args.buckets:
         n = 0
         with open(args.found_blobs, 'w') as f:
-            series_iterator = client.list_blobs(bucket, versions=False, page_size=args.batch, \
-                                                prefix='', delimiter='/')
-            for page in series_iterator.pages:
-                prefixes = [prefix for prefix in page.prefixes]
+            for prefixes in list_bucket(bucket, page_size=args.batch, delimiter='/', client=client):
                 task_queue.put((bucket,prefixes, n))
 
     # Tell child processes to stop
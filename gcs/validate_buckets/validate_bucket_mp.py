@@ -15,17 +15,24 @@
 #
 
 """
-Validate that a bucket holds the correct set of instance blobs
+Validate that a bucket holds the correct set of instance blobs.
+The expected blob names (from BQ) and the found blob names (from a listing of the bucket)
+are each written to a file in sorted order, and the files are then merged in a single pass,
+so neither side is held in memory.
 """
 import settings
 import builtins
 # Noramlly the progresslogger file is trunacated. The following causes it to be appended.
 # builtins.APPEND_PROGRESSLOGGER = True
 from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.bucket_listing import list_bucket
 from google.cloud import storage, bigquery
-from multiprocessing import Process, Queue
 
+UNEXPECTED_BLOBS = f'{settings.LOG_DIR}/unexpected_blobs.txt'
+MISSING_BLOBS = f'{settings.LOG_DIR}/missing_blobs.txt'
 
+
+# Write the sorted names of the blobs expected to be in the bucket to args.expected_blobs
 def get_expected_blobs_in_bucket(args, premerge=False):
     client = bigquery.Client()
     query = f"""
@@ -41,109 +48,76 @@ def get_expected_blobs_in_bucket(args, premerge=False):
   """
 
     query_job = client.query(query)
-    blob_names = set(query_job.result().to_dataframe()['blob_name'].to_list())
-    return blob_names
-
-def get_expected_series_in_bucket(args):
-    client = bigquery.Client()
-    query = f"""
-      SELECT distinct concat(se_uuid,'/') as series_uuid
-      FROM `idc-dev-etl.idc_v{args.version}_dev.all_joined` aj
-      JOIN `idc-dev-etl.idc_v{args.version}_dev.all_collections` aic
-      ON aj.idc_collection_id = aic.idc_collection_id
-      WHERE ((i_source='tcia' and aic.{"dev" if args.dev_or_pub=="dev" else "pub_gcs"}_tcia_url="{args.bucket}")
-      OR (i_source='idc' and aic.{"dev" if args.dev_or_pub=="dev" else "pub_gcs"}_idc_url="{args.bucket}"))
-      AND i_excluded = False
-      ORDER BY series_uuid
-  """
-
-    query_job = client.query(query)  # Make an API request.
-    series_uuids = [row.series_uuid for row in query_job.result()]
-
-    return series_uuids
-
-def worker(input, args):
-    RETRIES=3
-    client = storage.Client()
-    bucket = client.bucket(args.bucket)
-    for series_uuids, n in iter(input.get, 'STOP'):
-            for series_uuid in series_uuids:
-                try:
-                    instance_iterator = client.list_blobs(bucket, versions=False, page_size=args.batch, \
-                                     prefix=series_uuid)
-                    for page in instance_iterator.pages:
-                        for blob in page:
-                            successlogger.info(blob.name)
-                    progresslogger.info(series_uuid)
-                except Exception as exc:
-                    errlogger.error(f'p{args.id}: Error {exc}')
+    query_job.result()
+    destination = client.get_table(query_job.destination)
+    with open(args.expected_blobs, 'w') as f:
+        for page in client.list_rows(destination, page_size=int(args.batch)).pages:
+            f.write(''.join(f'{row.blob_name}\n' for row in page))
 
 
+# Write the sorted names of the blobs in the bucket to args.found_blobs
 def get_found_blobs_in_bucket(args):
     client = storage.Client()
-    bucket = client.bucket(args.bucket)
-
-    # Get expect series
-    expected_series = get_expected_series_in_bucket(args)
-
-    # Get the completed series
-    done_series = open(f'{progresslogger.handlers[0].baseFilename}').read().splitlines()
-
-    undone_series = list(set(expected_series) - set(done_series))
-    undone_series.sort()
-    # Start worker processes
-    num_processes = args.processes
-    processes = []
-    task_queue = Queue()
-    for process in range(num_processes):
-        args.id = process + 1
-        processes.append(
-            Process(group=None, target=worker, args=(task_queue, args)))
-        processes[-1].start()
-
-    # iterator = client.list_blobs(bucket, page_token=page_token, max_results=args.batch)
-    batch_size = 100
-    n = 0
     with open(args.found_blobs, 'w') as f:
-        while undone_series:
-            batch = undone_series[:batch_size]
-            undone_series = undone_series[batch_size:]
-            task_queue.put((batch, n))
-
-
-    # Tell child processes to stop
-    for i in range(num_processes):
-        task_queue.put('STOP')
-        task_queue.put('STOP')
-    # Wait for process to terminate
-    for process in processes:
-        print(f'Joining process: {process.name}, {process.is_alive()}')
-        process.join()
+        for page in list_bucket(args.bucket, page_size=int(args.batch), ordered=True, client=client):
+            f.write(''.join(f'{blob.name}\n' for blob in page))
+
+
+def read_names(path):
+    with open(path) as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+# Merge two sorted iterators of names. Names that are only found are written to unexpected,
+# names that are only expected are written to missing. Returns the number of each.
+def merge_diff(found, expected, unexpected, missing):
+    unexpected_count = missing_count = 0
+    found_name = next(found, None)
+    expected_name = next(expected, None)
+    while found_name is not None or expected_name is not None:
+        if expected_name is None or (found_name is not None and found_name < expected_name):
+            unexpected.write(f'{found_name}\n')
+            unexpected_count += 1
+            found_name = next(found, None)
+        elif found_name is None or expected_name < found_name:
+            missing.write(f'{expected_name}\n')
+            missing_count += 1
+            expected_name = next(expected, None)
+        else:
+            found_name = next(found, None)
+            expected_name = next(expected, None)
+    return unexpected_count, missing_count
+
+
+def has_names(path):
+    try:
+        with open(path) as f:
+            return bool(f.readline())
+    except FileNotFoundError:
+        return False
 
 
 def check_all_instances_mp(args, premerge=False):
-    try:
-        found_blobs = set(open(args.found_blobs).read().splitlines())
-        assert len(found_blobs) > 0
+    if has_names(args.found_blobs):
         progresslogger.info(f'Already have found blobs')
-    except:
+    else:
         progresslogger.info(f'Getting found blobs')
         get_found_blobs_in_bucket(args)
-        found_blobs = set(open(args.found_blobs).read().splitlines())
 
-    expected_blobs = get_expected_blobs_in_bucket(args, premerge)
+    progresslogger.info(f'Getting expected blobs')
+    get_expected_blobs_in_bucket(args, premerge)
 
+    with open(UNEXPECTED_BLOBS, 'w') as unexpected, open(MISSING_BLOBS, 'w') as missing:
+        unexpected_count, missing_count = merge_diff(read_names(args.found_blobs), read_names(args.expected_blobs),
+                                                     unexpected, missing)
 
-    if found_blobs == expected_blobs:
+    if not unexpected_count and not missing_count:
         successlogger.info(f"Bucket {args.bucket} has the correct set of blobs")
     else:
         errlogger.error(f"Bucket {args.bucket} does not have the correct set of blobs")
-        errlogger.error(f"Unexpected blobs in bucket: {len(found_blobs - expected_blobs)}")
-        for blob in found_blobs - expected_blobs:
-            errlogger.error(blob)
-        errlogger.error(f"Expected blobs not found in bucket: {len(expected_blobs - found_blobs)}")
-        for blob in expected_blobs - found_blobs:
-            errlogger.error(blob)
+        errlogger.error(f"Unexpected blobs in bucket: {unexpected_count}, listed in {UNEXPECTED_BLOBS}")
+        errlogger.error(f"Expected blobs not found in bucket: {missing_count}, listed in {MISSING_BLOBS}")
 
     return
 
@@ -545,6 +545,7 @@ class IDC_Collection(Base):
     __tablename__ = 'idc_collection'
     collection_id = Column(String, unique=True, primary_key=True, comment='NBIA collection ID')
     hash = Column(String, comment='Collection hash')
+    dirty = Column(Boolean, default=False, comment='True if the hash of this collection must be recomputed')
 
     # vers = relationship("IDC_Version", back_populates="collections")
     patients = relationship("IDC_Patient", back_populates="collection", order_by="IDC_Patient.submitter_case_id", cascade="all, delete")
@@ -557,6 +558,7 @@ class IDC_Patient(Base):
     submitter_case_id = Column(String, nullable=False, unique=True, primary_key=True, comment="Submitter's patient ID")
     collection_id = Column(ForeignKey('idc_collection.collection_id'), comment="Containing object")
     hash = Column(String, comment='Patient hash')
+    dirty = Column(Boolean, default=False, comment='True if the hash of this patient must be recomputed')
 
     collection = relationship("IDC_Collection", back_populates="patients")
     studies = relationship("IDC_Study", back_populates="patient", order_by="IDC_Study.study_instance_uid", cascade="all, delete")
@@ -569,6 +571,7 @@ class IDC_Study(Base):
     study_instance_uid = Column(String, unique=True, primary_key=True, nullable=False)
     submitter_case_id = Column(ForeignKey('idc_patient.submitter_case_id'), comment="Submitter's patient ID")
     hash = Column(String, comment='Study hash')
+    dirty = Column(Boolean, default=False, comment='True if the hash of this study must be recomputed')
 
     patient = relationship("IDC_Patient", back_populates="studies")
     seriess = relationship("IDC_Series", back_populates="study", order_by="IDC_Series.series_instance_uid", cascade="all, delete")
@@ -581,6 +584,7 @@ class IDC_Series(Base):
     series_instance_uid = Column(String, unique=True, primary_key=True, nullable=False)
     study_instance_uid = Column(ForeignKey('idc_study.study_instance_uid'), comment="Containing object")
     hash = Column(String, comment='Series hash')
+    dirty = Column(Boolean, default=False, comment='True if the hash of this series must be recomputed')
     excluded = Column(Boolean, comment='True of this series should be excluded from ingestion')
     source_doi = Column(String, comment='Source DOI of this series\' wiki')
     source_url = Column(String, comment='Source URL of this series\' wiki')
@@ -20,6 +20,7 @@ from idc.models  import Collection_id_map, instance_source
 from ingestion.utilities.utils import to_webapp, get_merkle_hash
 from google.cloud import bigquery
 from ingestion.sources import TCIA, IDC
+from ingestion.expansion import prefetch_tcia_patient
 from utilities.logging_config import successlogger, progresslogger, errlogger, rootlogger
 # rootlogger = logging.getLogger('root')
 # errlogger = logging.getLogger('root.err')
@@ -32,12 +33,43 @@ class All:
         self.idc_version = version
         self.client = bigquery.Client()
         self.sources = {}
+        # Source hashes gotten during this run, indexed by (level, id, source). An object's source
+        # hashes are gotten when it is checked for revision and again when it is validated
+        # after being built. Patient hashes aren't memoized: a patient is checked by the parent
+        # process and validated by a worker, so the memo would never hit.
+        self.src_hashes = {}
+        self.src_hash_hits = 0
+        self.src_hash_misses = 0
         try:
-            self.sources[instance_source.tcia] = TCIA(pid, sess, access, skipped_tcia_collections, lock)
+            self.sources[instance_source.tcia] = TCIA(pid, sess, skipped_tcia_collections)
             self.sources[instance_source.idc] = IDC(sess, skipped_idc_collections)
         except Exception as exc:
             print(exc)
 
+    # Get the hash of an object from a source, if not previously gotten
+    def src_hash(self, level, id, source, get_hash):
+        key = (level, id, source.value)
+        if key in self.src_hashes:
+            self.src_hash_hits += 1
+            return self.src_hashes[key]
+        self.src_hash_misses += 1
+        hash = get_hash()
+        # A -1 indicates that the source failed to return a hash
+        if hash != -1:
+            self.src_hashes[key] = hash
+        return hash
+
+
+    # Forget an object's source hashes, e.g. when it is done being built, or when it is
+    # found to be unchanged and won't be checked again
+    def invalidate_src_hashes(self, level, id):
+        for source in self.sources:
+            self.src_hashes.pop((level, id, source.value), None)
+
+
+    def src_hash_stats(self):
+        return f'src hash hits: {self.src_hash_hits}, misses: {self.src_hash_misses}'
+
     ###-------------------Versions-----------------###
 
     def idc_version_hashes(self, version):
@@ -116,7 +148,8 @@ class All:
             if skipped_sources[source.value]:
                 collection_hashes[source.value] = ""
             else:
-                collection_hashes[source.value] = self.sources[source].src_collection_hash(collection_id)
+                collection_hashes[source.value] = self.src_hash('collection', collection_id, source,
+                    lambda: self.sources[source].src_collection_hash(collection_id))
         return collection_hashes
 
 
@@ -155,6 +188,13 @@ class All:
         return patients
 
 
+    # Concurrently get the source listings and hashes that expanding a patient, and its
+    # revised descendants, will need. Only the TCIA source has such network-bound lookups.
+    def prefetch_patient_tree(self, collection, patient, skipped_sources):
+        if not skipped_sources[instance_source.tcia.value]:
+            prefetch_tcia_patient(self.sources[instance_source.tcia], collection, patient)
+
+
     # Get objects per-source hashes from DB
     def idc_patient_hashes(self, patient):
         childrens_hashes = [object.hashes for object in patient.studies]
@@ -163,6 +203,14 @@ class All:
         return parent_hashes
 
 
+    # Get, concurrently, the source hashes of patients that are about to be checked for revision.
+    # Subsequent src_patient_hashes() calls are served from the sources' caches.
+    def prefetch_patient_hashes(self, collection_id, submitter_case_ids, skipped_sources):
+        for source in self.sources:
+            if not skipped_sources[source.value]:
+                self.sources[source].prefetch_patient_hashes(collection_id, submitter_case_ids)
+
+
     # Compute object's hashes according to sources
     def src_patient_hashes(self, collection_id, submitter_case_id, skipped_sources):
         patient_hashes = ['','']
@@ -233,6 +281,13 @@ class All:
         return parent_hashes
 
 
+    # Get, concurrently, the source hashes of studies that are about to be checked for revision
+    def prefetch_study_hashes(self, collection_id, study_instance_uids, skipped_sources):
+        for source in self.sources:
+            if not skipped_sources[source.value]:
+                self.sources[source].prefetch_study_hashes(collection_id, study_instance_uids)
+
+
     # Compute object's hashes according to sources
     def src_study_hashes(self, collection_id, study_instance_uid, skipped_sources):
         study_hashes = ['','']
@@ -240,7 +295,8 @@ class All:
             if skipped_sources[source.value]:
                 study_hashes[source.value] = ""
             else:
-                study_hashes[source.value] = self.sources[source].src_study_hash(collection_id, study_instance_uid)
+                study_hashes[source.value] = self.src_hash('study', study_instance_uid, source,
+                    lambda: self.sources[source].src_study_hash(collection_id, study_instance_uid))
         return study_hashes
 
     ###-------------------Series-----------------###
@@ -289,6 +345,13 @@ class All:
         return series_hashes
 
 
+    # Get, concurrently, the source hashes of series that are about to be checked for revision
+    def prefetch_series_hashes(self, collection_id, series_instance_uids, skipped_sources):
+        for source in self.sources:
+            if not skipped_sources[source.value]:
+                self.sources[source].prefetch_series_hashes(series_instance_uids)
+
+
     # Compute object's hashes according to sources
     def src_series_hashes(self, collection_id, series_instance_uid, skipped_sources):
         series_hashes = ['', '']
@@ -296,7 +359,8 @@ class All:
             if skipped_sources[source.value]:
                 series_hashes[source.value] = ""
             else:
-                series_hashes[source.value] = self.sources[source].src_series_hash(series_instance_uid)
+                series_hashes[source.value] = self.src_hash('series', series_instance_uid, source,
+                    lambda: self.sources[source].src_series_hash(series_instance_uid))
 
         return series_hashes
 
@@ -323,6 +387,11 @@ class All:
         return instances
 
 
+    # Get, concurrently, the source hashes of instances that are about to be checked for revision
+    def prefetch_instance_hashes(self, sop_instance_uids, source):
+        self.sources[instance_source[source]].prefetch_instance_hashes(sop_instance_uids)
+
+
     # Compute object's hashes according to sources
     def src_instance_hashes(self, sop_instance_uid, source):
         instance_hash = self.sources[instance_source[source]].src_instance_hash(sop_instance_uid)
@@ -18,12 +18,13 @@ import time
 from datetime import datetime, timedelta
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
-from idc.models import instance_source, Version, Collection, Patient
+from idc.models import instance_source, Version, Collection, Patient, Study, patient_study
 from ingestion.utilities.utils import accum_sources, empty_bucket, create_prestaging_bucket, is_skipped
 from ingestion.patient import clone_patient, build_patient, retire_patient
 from ingestion.all_sources import All
-from utilities.sqlalchemy_helpers import sa_session
+from utilities.sqlalchemy_helpers import sa_session, eager_hierarchy
 from python_settings import settings
+from sqlalchemy import func
 
 from multiprocessing import Process, Queue, Lock, shared_memory
 from queue import Empty
@@ -56,20 +57,27 @@ def worker(input, output, args, access, lock):
             for attempt in range(PATIENT_TRIES):
                 time.sleep((2**attempt)-1)
                 index, collection_id, submitter_case_id = more_args
+                set_prestaging_buckets(args, collection_id)
                 try:
                     version = sess.query(Version).filter(Version.version==settings.CURRENT_VERSION).one()
-                    collection = next(collection for collection in version.collections if collection.collection_id ==collection_id)
-                    patient = next(patient for patient in collection.patients if patient.submitter_case_id==submitter_case_id)
+                    # Query the collection and patient directly rather than loading all the version's
+                    # collections and all the collection's patients for every task. The patient's studies
+                    # and series are loaded with it.
+                    collection = sess.query(Collection).join(Collection.versions). \
+                        filter(Version.version==settings.CURRENT_VERSION, Collection.collection_id==collection_id).one()
+                    patient = sess.query(Patient).join(Patient.collections). \
+                        filter(Collection.uuid==collection.uuid, Patient.submitter_case_id==submitter_case_id). \
+                        options(eager_hierarchy(Patient, 2)).one()
                     build_patient(sess, args, all_sources, index, version, collection, patient)
                     break
                 except Exception as exc:
-                    errlogger.error("p%s, exception %s; reattempt %s on patient %s/%s, %s; %s", args.pid, exc, attempt, collection.collection_id, patient.submitter_case_id, index, time.asctime())
+                    errlogger.error("p%s, exception %s; reattempt %s on patient %s/%s, %s; %s", args.pid, exc, attempt, collection_id, submitter_case_id, index, time.asctime())
                     sess.rollback()
 
             if attempt == PATIENT_TRIES - 1:
-                errlogger.error("p%s, Failed to process patient: %s", args.pid, patient.submitter_case_id)
+                errlogger.error("p%s, Failed to process patient: %s", args.pid, submitter_case_id)
                 sess.rollback()
-            output.put(patient.submitter_case_id)
+            output.put((collection_id, submitter_case_id))
 
 
 def expand_collection(sess, args, all_sources, collection):
@@ -87,6 +95,10 @@ def expand_collection(sess, args, all_sources, collection):
     # retire it from the source.
     patients = all_sources.patients(collection, skipped)
 
+    # Load the collection's patients and their studies, which the revision checks below walk, together
+    if not collection.is_new:
+        sess.query(Collection).filter(Collection.uuid==collection.uuid).options(eager_hierarchy(Collection, 2)).one()
+
     # Since we are starting, delete everything from the prestaging bucket.
     if collection.revised.tcia:
         progresslogger.info("Emptying tcia prestaging buckets")
@@ -150,6 +162,8 @@ def expand_collection(sess, args, all_sources, collection):
         collection.patients.append(new_patient)
         progresslogger.info('  p%s: Patient %s is new',  args.pid, new_patient.submitter_case_id)
 
+    all_sources.prefetch_patient_hashes(collection.collection_id,
+        [patient.submitter_case_id for patient in existing_objects], skipped)
     for patient in existing_objects:
         idc_hashes = patient.hashes
         # Get the hash from each source that is not skipped
@@ -223,89 +237,34 @@ def expand_collection(sess, args, all_sources, collection):
     return
 
 
+# The prestaging buckets of a collection
+def set_prestaging_buckets(args, collection_id):
+    args.prestaging_tcia_bucket = f"{args.prestaging_tcia_bucket_prefix}{collection_id.lower().replace(' ','_').replace('-','_')}"
+    args.prestaging_idc_bucket = f"{args.prestaging_idc_bucket_prefix}{collection_id.lower().replace(' ','_').replace('-','_')}"
+
+
 def build_collection(sess, args, all_sources, collection_index, version, collection):
     begin = time.time()
     successlogger.info("p%s: Expand Collection %s, %s", args.pid, collection.collection_id, collection_index)
-    args.prestaging_tcia_bucket = f"{args.prestaging_tcia_bucket_prefix}{collection.collection_id.lower().replace(' ','_').replace('-','_')}"
-    args.prestaging_idc_bucket = f"{args.prestaging_idc_bucket_prefix}{collection.collection_id.lower().replace(' ','_').replace('-','_')}"
+    set_prestaging_buckets(args, collection.collection_id)
     if not collection.expanded:
         expand_collection(sess, args, all_sources, collection)
     successlogger.info("p%s: Expanded Collection %s, %s, %s patients", args.pid, collection.collection_id, collection_index, len(collection.patients))
 
-    if args.num_processes==0:
-        patients = sorted(collection.patients, key=lambda patient: patient.done, reverse=True)
-        for patient in patients:
-            patient_index = f'{patients.index(patient) + 1} of {len(patients)}'
-            if not patient.done:
-                # build_patient(sess, args, all_sources, patient_index, data_collection_doi_url, analysis_collection_dois, version, collection, patient)
-                build_patient(sess, args, all_sources, patient_index, version, collection, patient)
-            else:
-                if True:
-                    successlogger.info("  p0: Patient %s, %s, previously built", patient.submitter_case_id,
-                                patient_index)
-
-    else:
-        processes = []
-        # Create queues
-        task_queue = Queue()
-        done_queue = Queue()
-
-        # List of patients enqueued
-        enqueued_patients = []
-
-        num_processes = min(args.num_processes, len(collection.patients))
-
-        # Enqueue each patient in the the task queue
-        # patients = sorted(collection.patients, key=lambda patient: patient.done, reverse=True)
-        all_patients = [patient for patient in collection.patients]
-        all_patients = sorted(all_patients, key=lambda patient: patient.submitter_case_id)
-        patients = [patient for patient in collection.patients if patient.done==False]
-        patients = sorted(patients, key=lambda patient: patient.submitter_case_id)
-        # Start worker processes
-        lock = Lock()
-        for process in range(min(num_processes, len(patients))):
-            args.pid = process+1
-            processes.append(
-                Process(target=worker, args=(task_queue, done_queue, args, args.access, lock )))
-            processes[-1].start()
-
-        args.pid = 0
-        for patient in patients:
-            patient_index = f'{all_patients.index(patient) + 1} of {len(all_patients)}'
-            if not patient.done:
-                task_queue.put((patient_index, collection.collection_id, patient.submitter_case_id))
-                enqueued_patients.append(patient.submitter_case_id)
-            else:
-                successlogger.info("  p%s: Patient %s, %s, previously built", args.pid, patient.submitter_case_id,
-                            patient_index)
-
-        # Collect the results for each patient
-        try:
-            while not enqueued_patients == []:
-                # Timeout if waiting too long
-                results = done_queue.get(True)
-                enqueued_patients.remove(results)
-
-            # Tell child processes to stop
-            for process in processes:
-                task_queue.put('STOP')
+    patients = sorted(collection.patients, key=lambda patient: patient.done, reverse=True)
+    for patient in patients:
+        patient_index = f'{patients.index(patient) + 1} of {len(patients)}'
+        if not patient.done:
+            build_patient(sess, args, all_sources, patient_index, version, collection, patient)
+        else:
+            successlogger.info("  p0: Patient %s, %s, previously built", patient.submitter_case_id,
+                        patient_index)
 
-            # Wait for them to stop
-            for process in processes:
-                process.join()
+    finalize_collection(sess, args, all_sources, collection_index, collection, begin)
 
-            sess.commit()
-
-        except Empty as e:
-            errlogger.error("Timeout in build_collection %s", collection.collection_id)
-            for process in processes:
-                process.terminate()
-                process.join()
-            sess.rollback()
-            duration = str(timedelta(seconds=(time.time() - begin)))
-            successlogger.info("Collection %s, %s, NOT completed in %s", collection.collection_id, collection_index,
-                            duration)
 
+# Validate and record the hashes of a collection whose patients have all been built
+def finalize_collection(sess, args, all_sources, collection_index, collection, begin):
     if all([patient.done for patient in collection.patients]):
         collection.max_timestamp = max([patient.max_timestamp for patient in collection.patients if patient.max_timestamp != None])
         try:
@@ -322,6 +281,7 @@ def build_collection(sess, args, all_sources, collection_index, version, collect
             # Compare hashes of unskipped sources
             revised = [(x != y) and not z for x, y, z in \
                        zip(idc_hashes[:-1], src_hashes, skipped)]
+            all_sources.invalidate_src_hashes('collection', collection.collection_id)
             if any(revised):
                 # raise Exception('Hash match failed for collection %s', collection.collection_id)
                 errlogger.error('Hash match failed for collection %s', collection.collection_id)
@@ -332,7 +292,7 @@ def build_collection(sess, args, all_sources, collection_index, version, collect
                 collection.sources = accum_sources(collection, collection.patients)
                 collection.done = True
                 duration = str(timedelta(seconds=(time.time() - begin)))
-                successlogger.info("Built Collection %s, %s, in %s", collection.collection_id, collection_index, duration)
+                successlogger.info("Built Collection %s, %s, in %s, %s", collection.collection_id, collection_index, duration, all_sources.src_hash_stats())
                 sess.commit()
 
         except Exception as exc:
@@ -348,3 +308,132 @@ def build_collection(sess, args, all_sources, collection_index, version, collect
         successlogger.info("Collection %s, %s, not completed in %s", collection.collection_id, collection_index,
                         duration)
 
+
+
+# Get the number of instances that each of some patients had when last built. A new
+# patient has no studies yet, so its size is 0.
+def get_patient_sizes(sess, patients):
+    sizes = dict(sess.query(patient_study.c.patient_uuid, func.sum(Study.study_instances)). \
+        join(Study, Study.uuid == patient_study.c.study_uuid). \
+        filter(patient_study.c.patient_uuid.in_([patient.uuid for patient in patients])). \
+        group_by(patient_study.c.patient_uuid).all())
+    return {patient.uuid: sizes.get(patient.uuid) or 0 for patient in patients}
+
+
+# Seconds to wait for a patient to be built before checking that the workers are alive
+WORKER_CHECK_INTERVAL = 60
+
+
+# Build the collections of a version with a single pool of worker processes.
+# The collections are expanded one at a time, and the unbuilt patients of each collection are
+# queued, largest first, as soon as it is expanded, so the workers build the patients of earlier
+# collections while later collections are being expanded. A collection is finalized as soon as its
+# last patient is done.
+# The size of a patient is the number of instances it had when last built. A new patient has no
+# such estimate; new patients are queued after the sized patients of their collection.
+def build_collections(sess, args, all_sources, version, collections):
+    begin = {}
+    indices = {}
+    # The unbuilt patients of each collection, indexed by collection_id
+    pending = {}
+    processes = []
+    task_queue = Queue()
+    done_queue = Queue()
+    lock = Lock()
+    collections_by_id = {collection.collection_id: collection for collection in collections}
+
+    # Record that a patient was built, and finalize its collection if it was the last
+    def patient_done(collection_id, submitter_case_id):
+        pending[collection_id].discard(submitter_case_id)
+        if not pending[collection_id]:
+            pending.pop(collection_id)
+            # Discard our stale view of the objects that the workers have built
+            sess.expire_all()
+            finalize_collection(sess, args, all_sources, indices[collection_id], collections_by_id[collection_id], begin[collection_id])
+            sess.commit()
+
+    # Wait for the result of some patient. Returns False if a worker died, in which case
+    # the patient that it was building will never be done.
+    def wait_for_patient():
+        while True:
+            try:
+                patient_done(*done_queue.get(True, WORKER_CHECK_INTERVAL))
+                return True
+            except Empty:
+                dead = [process.pid for process in processes if not process.is_alive()]
+                if dead:
+                    errlogger.error("Worker processes %s died in build_collections", dead)
+                    return False
+
+    for collection_number, collection in enumerate(collections):
+        collection_index = f'{collection_number + 1} of {len(collections)}'
+        if collection.done:
+            progresslogger.info("p%s: Collection %s, %s, previously built", args.pid, collection.collection_id, collection_index)
+            continue
+        begin[collection.collection_id] = time.time()
+        indices[collection.collection_id] = collection_index
+        successlogger.info("p%s: Expand Collection %s, %s", args.pid, collection.collection_id, collection_index)
+        set_prestaging_buckets(args, collection.collection_id)
+        if not collection.expanded:
+            expand_collection(sess, args, all_sources, collection)
+        successlogger.info("p%s: Expanded Collection %s, %s, %s patients", args.pid, collection.collection_id, collection_index, len(collection.patients))
+
+        all_patients = sorted(collection.patients, key=lambda patient: patient.submitter_case_id)
+        patients = [patient for patient in all_patients if not patient.done]
+        sizes = get_patient_sizes(sess, patients)
+        tasks = []
+        for patient_number, patient in enumerate(all_patients):
+            patient_index = f'{patient_number + 1} of {len(all_patients)}'
+            if patient.done:
+                successlogger.info("  p%s: Patient %s, %s, previously built", args.pid, patient.submitter_case_id,
+                            patient_index)
+            else:
+                tasks.append((sizes[patient.uuid], patient_index, collection.collection_id, patient.submitter_case_id))
+        pending[collection.collection_id] = set(patient.submitter_case_id for patient in patients)
+        if not tasks:
+            # Nothing left to build
+            pending.pop(collection.collection_id)
+            finalize_collection(sess, args, all_sources, collection_index, collection, begin[collection.collection_id])
+            continue
+
+        # Start the worker processes when there is first something to build
+        if not processes:
+            for process in range(args.num_processes):
+                args.pid = process+1
+                processes.append(
+                    Process(target=worker, args=(task_queue, done_queue, args, args.access, lock )))
+                processes[-1].start()
+            args.pid = 0
+
+        # Enqueue the collection's patients, largest first. The sort is stable, so new
+        # patients stay in submitter_case_id order.
+        for size, patient_index, collection_id, submitter_case_id in sorted(tasks, key=lambda task: task[0], reverse=True):
+            task_queue.put((patient_index, collection_id, submitter_case_id))
+
+        # Finalize the collections whose patients were built while this one was being expanded
+        try:
+            while True:
+                patient_done(*done_queue.get_nowait())
+        except Empty:
+            pass
+
+    # Collect the results of the remaining patients
+    while pending:
+        if not wait_for_patient():
+            for process in processes:
+                process.terminate()
+                process.join()
+            sess.rollback()
+            for collection_id in pending:
+                duration = str(timedelta(seconds=(time.time() - begin[collection_id])))
+                successlogger.info("Collection %s, %s, NOT completed in %s", collection_id, indices[collection_id],
+                                duration)
+            return
+
+    # Tell child processes to stop
+    for process in processes:
+        task_queue.put('STOP')
+
+    # Wait for them to stop
+    for process in processes:
+        process.join()
@@ -0,0 +1,122 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Concurrent expansion of a patient's TCIA hierarchy.
+# expand_patient() -> expand_study() -> expand_series() walk a patient depth first, and each
+# of their listing and hash requests is a blocking NBIA round trip. Before a patient is built,
+# expand_tcia_patient() walks the patient's TCIA hierarchy with asyncio, with a limit on the
+# number of concurrent requests at each level. It descends into new objects and into existing
+# objects whose TCIA hash differs from the hash in the DB, the objects that the expand_*()
+# functions will later expand. The listings and hashes that it gets are left in the TCIA
+# source's caches, and the expand_*() functions then make their new/existing/retired decisions,
+# and apply them to the session, in their usual order without waiting on NBIA.
+# The DB is only accessed from the event loop's thread; NBIA requests run in a thread pool.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from idc.models import instance_source
+from utilities.tcia_helpers import get_TCIA_studies_per_patient, get_TCIA_series_per_study, \
+    get_TCIA_instance_uids_per_series
+from utilities.logging_config import progresslogger
+
+# Maximum number of concurrent NBIA requests at each level
+STUDY_REQUESTS = 4
+SERIES_REQUESTS = 8
+INSTANCE_REQUESTS = 16
+
+
+class TCIAExpander:
+    def __init__(self, tcia, collection_id, submitter_case_id):
+        self.tcia = tcia
+        self.collection_id = collection_id
+        self.submitter_case_id = submitter_case_id
+        self.semaphores = {
+            'study': asyncio.Semaphore(STUDY_REQUESTS),
+            'series': asyncio.Semaphore(SERIES_REQUESTS),
+            'instance': asyncio.Semaphore(INSTANCE_REQUESTS)
+        }
+        self.executor = ThreadPoolExecutor(max_workers=STUDY_REQUESTS + SERIES_REQUESTS + INSTANCE_REQUESTS)
+
+    async def call(self, level, func, *args):
+        async with self.semaphores[level]:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    # Get the TCIA hash of an existing object. It is left in the source's cache for the expand_*() check
+    async def hash(self, level, uid, request_data):
+        if level == 'instance':
+            result = await self.call(level, self.tcia.get_instance_hash, uid)
+        else:
+            result = await self.call(level, self.tcia.get_hash, request_data)
+        if not result:
+            return None
+        src_hash = result.content.decode()
+        self.tcia.hashes[(level, uid)] = src_hash
+        return src_hash
+
+    # An existing object needs to be expanded if its TCIA hash has changed. If its hash
+    # can't be gotten, it is left to expand_*() to get it and handle the failure.
+    async def is_revised(self, level, uid, request_data, idc_object):
+        if idc_object is None:
+            return True
+        src_hash = await self.hash(level, uid, request_data)
+        return src_hash is not None and src_hash != idc_object.hashes[instance_source.tcia.value]
+
+    async def expand_patient(self, patient):
+        study_uids = [study['StudyInstanceUID'] for study in await self.call('study',
+            get_TCIA_studies_per_patient, self.collection_id, self.submitter_case_id, self.tcia.nbia_server)]
+        self.tcia.listings[('studies', self.submitter_case_id)] = study_uids
+        idc_studies = {} if patient.is_new else {study.study_instance_uid: study for study in patient.studies}
+        await asyncio.gather(*[self.expand_study(uid, idc_studies.get(uid)) for uid in study_uids])
+
+    async def expand_study(self, study_instance_uid, idc_study):
+        if not await self.is_revised('study', study_instance_uid, {'StudyInstanceUID': study_instance_uid}, idc_study):
+            return
+        series_uids = [series['SeriesInstanceUID'] for series in await self.call('series',
+            get_TCIA_series_per_study, self.collection_id, self.submitter_case_id, study_instance_uid,
+            self.tcia.nbia_server)]
+        self.tcia.listings[('series', study_instance_uid)] = series_uids
+        idc_seriess = {} if idc_study is None else {series.series_instance_uid: series for series in idc_study.seriess}
+        await asyncio.gather(*[self.expand_series(uid, idc_seriess.get(uid)) for uid in series_uids])
+
+    async def expand_series(self, series_instance_uid, idc_series):
+        if not await self.is_revised('series', series_instance_uid, {'SeriesInstanceUID': series_instance_uid}, idc_series):
+            return
+        instance_uids = [instance['SOPInstanceUID'] for instance in await self.call('instance',
+            get_TCIA_instance_uids_per_series, self.collection_id, series_instance_uid, self.tcia.nbia_server)]
+        self.tcia.listings[('instances', series_instance_uid)] = instance_uids
+        if idc_series is not None:
+            # Get the hashes of the instances that the series still has
+            existing_uids = set(instance_uids) & set(instance.sop_instance_uid for instance in idc_series.instances)
+            await asyncio.gather(*[self.hash('instance', uid, None) for uid in existing_uids])
+
+
+async def expand_tcia_patient(tcia, collection, patient):
+    expander = TCIAExpander(tcia, collection.collection_id, patient.submitter_case_id)
+    try:
+        await expander.expand_patient(patient)
+    finally:
+        expander.executor.shutdown(wait=True)
+
+
+# Run the concurrent TCIA expansion of a patient. A failure isn't fatal; the expand_*()
+# functions request whatever is not in the caches.
+def prefetch_tcia_patient(tcia, collection, patient):
+    tcia.listings.clear()
+    try:
+        asyncio.run(expand_tcia_patient(tcia, collection, patient))
+    except Exception as exc:
+        progresslogger.info('p%s: Concurrent expansion of patient %s failed: %s', tcia.pid, patient.submitter_case_id, exc)
@@ -26,6 +26,7 @@ import shutil
 from multiprocessing import Lock, shared_memory
 from idc.models import Base, Version, Collection
 from utilities.tcia_helpers import get_access_token
+from utilities.nbia_cache import enable_listing_cache, NBIA_CACHE, NBIA_CACHE_TTL
 from utilities.sqlalchemy_helpers import sa_session
 from utilities.logging_config import successlogger, errlogger, progresslogger, rootlogger
 from ingestion.utilities.utils import list_skips
@@ -43,6 +44,11 @@ def ingest(args):
         shutil.rmtree('{}'.format(args.dicom_dir))
     os.mkdir('{}'.format(args.dicom_dir))
 
+    # Replay NBIA listings made by a previous, interrupted, run. Opt in only: hashes are
+    # always gotten live, so a replayed listing that is stale can fail hash validation.
+    if args.nbia_cache_ttl:
+        enable_listing_cache(args.nbia_cache, args.nbia_cache_ttl)
+
     with sa_session() as sess:
         # Get a sharable NBIA access token
         access = shared_memory.ShareableList(get_access_token())
@@ -132,6 +138,18 @@ if __name__ == '__main__':
     # parser.add_argument('--server', default="", help="NBIA server to access. Set to NLST for NLST ingestion")
     parser.add_argument('--prestaging_idc_bucket_prefix', default=f'idc_v{settings.CURRENT_VERSION}_idc_', help='Copy idc instances here before forwarding to --staging_bucket')
 
+    parser.add_argument('--stream_tcia', type=bool, default=False, \
+                        help='Stream TCIA series to the prestaging bucket instead of downloading them to local disk')
+    parser.add_argument('--series_threads', type=int, default=0, \
+                        help="Number of series of a patient that are built concurrently, each in its own DB session. 0 builds them serially")
+    parser.add_argument('--async_expansion', type=bool, default=False, \
+                        help='Concurrently get the NBIA listings and hashes of a patient before expanding it')
+    parser.add_argument('--nbia_cache', default=NBIA_CACHE, \
+                        help='SQLite file in which NBIA listings are cached across runs')
+    parser.add_argument('--nbia_cache_ttl', type=int, default=0, \
+                        help=f'Seconds after which a cached NBIA listing expires, e.g. {NBIA_CACHE_TTL}. 0, the default, disables the cache')
+    parser.add_argument('--gcs_audit_rate', type=float, default=0.0, \
+                        help='Fraction of copied blobs that are reloaded to audit the checksums recorded from GCS responses')
     parser.add_argument('--stop_after_collection_summary', type=bool, default=False, \
                         help='Stop after printing a summary of collection dispositions')
 
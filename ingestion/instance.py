@@ -25,8 +25,9 @@ from pydicom.errors import InvalidDicomError
 from idc.models import Version, Instance, IDC_Instance
 from sqlalchemy import select,delete
 from google.cloud import storage
-from utilities.tcia_helpers import  get_TCIA_instances_per_series_with_hashes
-from ingestion.utilities.utils import validate_hashes, md5_hasher, copy_disk_to_gcs, copy_gcs_to_gcs
+from utilities.tcia_helpers import  get_TCIA_instances_per_series_with_hashes, stream_TCIA_instances_per_series_with_hashes
+from ingestion.utilities.utils import copy_disk_to_gcs, copy_gcs_to_gcs_concurrently, dicom_file_info, get_dicom_ids, \
+    copy_memory_to_prestaging_bucket, rollback_blobs_in_prestaging_bucket, get_storage_client, validate_series_in_gcs
 
 # successlogger = logging.getLogger('root.success')
 # progresslogger = logging.getLogger('root.progress')
@@ -55,10 +56,7 @@ def build_instances_tcia(sess, args, collection, patient, study, series):
         # It will write the zip to a file dicom/<series_instance_uid>.zip in the
         # working directory, and expand the zip to directory dicom/<series_instance_uid>
         hashes = get_TCIA_instances_per_series_with_hashes(args.dicom_dir, series)
-        # Validate that the files on disk have the expected hashes.
-        if not validate_hashes(args, collection, patient, study, series, hashes):
-            # If validation fails, return. None of the instances will have the done bit set to True
-            return
+        expected_hashes = dict(row.split(',', 1) for row in hashes)
 
         # Get a list of the files from the download
         dcms = [dcm for dcm in os.listdir("{}/{}".format(args.dicom_dir, series.uuid))]
@@ -72,56 +70,52 @@ def build_instances_tcia(sess, args, collection, patient, study, series):
 
         # TCIA file names are based on the position of the image in a scan. We need to extract the SOPInstanceUID
         # so that we can know the instance.
-        # Use pydicom to open each file to get its UID and rename the file with its associated uuid that we
-        # generated when we expanded this series.
-
-        # Replace the TCIA assigned file name
-        # Also compute the md5 hash and length in bytes of each
+        # Open each file once to validate its hash, get its size and UIDs, and rename the file with its
+        # associated uuid that we generated when we expanded this series.
         instances = {instance.sop_instance_uid:instance for instance in series.instances}
 
         for dcm in dcms:
+            file_name = "{}/{}/{}".format(args.dicom_dir, series.uuid, dcm)
             try:
-                reader = pydicom.dcmread("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm), stop_before_pixels=True)
-                SOPInstanceUID = reader.SOPInstanceUID
+                hash, size, SOPInstanceUID, PatientID, StudyInstanceUID, SeriesInstanceUID = dicom_file_info(file_name)
             except InvalidDicomError:
                 errlogger.error("       p%s: Invalid DICOM file for %s/%s/%s/%s", args.pid,
                     collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid)
                 if collection.collection_id == 'NLST':
                     breakpoint()
                     # For NLST only, just delete the invalid file
-                    os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
+                    os.remove(file_name)
                     continue
                 else:
                     # Return without marking all instances done. This will be prevent the series from being done.
                     return
 
+            # Validate that the file was received with the expected hash.
+            if hash != expected_hashes.get(dcm):
+                errlogger.error("      p%s: Invalid hash for %s/%s/%s/%s/%s", args.pid,
+                    collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid, dcm)
+                # If validation fails, return. None of the instances will have the done bit set to True
+                return
+
             instance = instances[SOPInstanceUID]
-            # # If an instance is already done, don't need to do anything more
-            # if instance.done:
-            #     # Delete file. We already have it.
-            #     os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
-            #     progresslogger.debug("      p%s: Instance %s previously done, ", args.pid, series.uuid)
-            #
-            #     continue
 
             # Validate that DICOM IDs match what we are expecting
             try:
-                assert patient.submitter_case_id == reader.PatientID;
-                assert study.study_instance_uid == reader.StudyInstanceUID;
-                assert series.series_instance_uid == reader.SeriesInstanceUID;
+                assert patient.submitter_case_id == PatientID;
+                assert study.study_instance_uid == StudyInstanceUID;
+                assert series.series_instance_uid == SeriesInstanceUID;
             except:
                 errlogger.error(f"       p{args.pid}: DICOM ID mismatch for instance: {instance.sop_instance_uid} ")
                 errlogger.error(f'       p{args.pid}: PatientID: TCIA : {patient.submitter_case_id}, \
-                    DICOM: {reader.PatientID}')
-                errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {patient.study_instance_uid}, \
-                    DICOM: {reader.StudyInstanceUID}')
-                errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {patient.series_instance_uid}, \
-                    DICOM: {reader.SeriesInstanceUID}')
+                    DICOM: {PatientID}')
+                errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {study.study_instance_uid}, \
+                    DICOM: {StudyInstanceUID}')
+                errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {series.series_instance_uid}, \
+                    DICOM: {SeriesInstanceUID}')
                 # Return without marking all instances done. This will be prevent the series from being done.
                 return
 
             uuid = instance.uuid
-            file_name = "{}/{}/{}".format(args.dicom_dir, series.uuid, dcm)
             blob_name = "{}/{}/{}.dcm".format(args.dicom_dir, series.uuid, uuid)
             if os.path.exists(blob_name):
                 errlogger.error("       p%s: Duplicate DICOM files for %s/%s/%s/%s/%s", args.pid,
@@ -129,7 +123,7 @@ def build_instances_tcia(sess, args, collection, patient, study, series):
                 if collection.collection_id == 'NLST':
                     breakpoint()
                     # For NLST only, just delete the duplicate
-                    os.remove("{}/{}/{}".format(args.dicom_dir, series.uuid, dcm))
+                    os.remove(file_name)
                     continue
                 else:
                     # Return without marking all instances done. This will prevent the series from being done.
@@ -137,8 +131,8 @@ def build_instances_tcia(sess, args, collection, patient, study, series):
 
             os.rename(file_name, blob_name)
 
-            instance.hash = md5_hasher(blob_name)
-            instance.size = Path(blob_name).stat().st_size
+            instance.hash = hash
+            instance.size = size
             instance.timestamp = datetime.utcnow()
 
         if collection.collection_id == 'NLST':
@@ -165,9 +159,112 @@ def build_instances_tcia(sess, args, collection, patient, study, series):
         raise exc
 
 
+# Stream the instances of a series from NBIA directly to the prestaging bucket.
+# Returns True if every instance was received, validated and uploaded. The blobs
+# that were uploaded are appended to uploaded so that the caller can roll them back, and their
+# checksums are recorded in manifest.
+def stream_instances_to_prestaging_bucket(sess, args, bucket, collection, patient, study, series, uploaded, manifest):
+    instances = {instance.sop_instance_uid:instance for instance in series.instances}
+    seen = set()
+    dcms = 0
+    for dcm, data, hash, size, expected_hash in stream_TCIA_instances_per_series_with_hashes(series):
+        dcms += 1
+        # Validate that the instance was received with the expected hash.
+        if hash != expected_hash:
+            errlogger.error("      p%s: Invalid hash for %s/%s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid, dcm)
+            return False
+
+        # TCIA file names are based on the position of the image in a scan. Parse just the
+        # header of the instance to get its SOPInstanceUID.
+        try:
+            SOPInstanceUID, PatientID, StudyInstanceUID, SeriesInstanceUID = get_dicom_ids(data)
+        except InvalidDicomError:
+            errlogger.error("       p%s: Invalid DICOM file for %s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid)
+            if collection.collection_id == 'NLST':
+                # For NLST only, just skip the invalid file
+                continue
+            else:
+                return False
+
+        if SOPInstanceUID in seen:
+            errlogger.error("       p%s: Duplicate DICOM files for %s/%s/%s/%s/%s", args.pid,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, SOPInstanceUID)
+            if collection.collection_id == 'NLST':
+                # For NLST only, just skip the duplicate
+                continue
+            else:
+                return False
+        if SOPInstanceUID not in instances:
+            errlogger.error("       p%s: Unexpected instance %s in %s/%s/%s/%s", args.pid, SOPInstanceUID,
+                collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid)
+            raise RuntimeError(f'p{args.pid}: Unexpected instance {SOPInstanceUID} in series {series.series_instance_uid}')
+        instance = instances[SOPInstanceUID]
+
+        # Validate that DICOM IDs match what we are expecting
+        if patient.submitter_case_id != PatientID or \
+                study.study_instance_uid != StudyInstanceUID or \
+                series.series_instance_uid != SeriesInstanceUID:
+            errlogger.error(f"       p{args.pid}: DICOM ID mismatch for instance: {instance.sop_instance_uid} ")
+            errlogger.error(f'       p{args.pid}: PatientID: TCIA : {patient.submitter_case_id}, DICOM: {PatientID}')
+            errlogger.error(f'       p{args.pid}: StudyInstanceUID: TCIA : {study.study_instance_uid}, DICOM: {StudyInstanceUID}')
+            errlogger.error(f'       p{args.pid}: SeriesInstanceUID: TCIA : {series.series_instance_uid}, DICOM: {SeriesInstanceUID}')
+            return False
+
+        instance.hash = hash
+        instance.size = size
+        instance.timestamp = datetime.utcnow()
+        data.seek(0)
+        uploaded.append(copy_memory_to_prestaging_bucket(args, bucket, series, instance, data, manifest))
+        seen.add(SOPInstanceUID)
+
+    # Ensure that the zip has the expected number of instances
+    if not dcms == len(series.instances):
+        errlogger.error("      p%s: Invalid zip file for %s/%s/%s/%s", args.pid,
+            collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid)
+        return False
+
+    if collection.collection_id == 'NLST':
+        # For NLST only, delete any instances for which there is not a corresponding file
+        for instance in list(series.instances):
+            if not instance.sop_instance_uid in seen:
+                sess.execute(delete(Instance).where(Instance.uuid==instance.uuid))
+                series.instances.remove(instance)
+    return True
+
+
+# Like build_instances_tcia, but the series is never written to local disk. Each instance
+# is hashed, identified and uploaded to the prestaging bucket as it is read from the zip.
+def build_instances_tcia_stream(sess, args, collection, patient, study, series):
+    try:
+        client = get_storage_client()
+        bucket = client.bucket(args.prestaging_tcia_bucket)
+        uploaded = []
+        manifest = {}
+        try:
+            valid = stream_instances_to_prestaging_bucket(sess, args, bucket, collection, patient, study, series, uploaded, manifest)
+            if valid:
+                # Validate the uploads against the hash and size of each instance as it was received
+                validate_series_in_gcs(args, bucket, series, manifest)
+        except:
+            rollback_blobs_in_prestaging_bucket(args, uploaded)
+            raise
+        if not valid:
+            # Return without marking all instances done. This will prevent the series from being done.
+            rollback_blobs_in_prestaging_bucket(args, uploaded)
+            return
+
+        for instance in series.instances:
+            instance.done = True
+    except Exception as exc:
+        errlogger.info('  p%s build_instances_tcia_stream failed: %s', args.pid, exc)
+        raise exc
+
+
 def build_instances_idc(sess, args, collection, patient, study, series):
 
-    client=storage.Client()
+    client = get_storage_client()
 
     # When idc is the source of instance data, the instances are already in a bucket.
     # From idc_xxx DB hierarchy, we get a table of the SOPInstanceUID, hash and GCS URL of
@@ -177,25 +274,35 @@ def build_instances_idc(sess, args, collection, patient, study, series):
     result = sess.execute(stmt)
     src_instance_metadata = {i.sop_instance_uid:{'gcs_url':i.gcs_url, 'hash':i.hash} \
                              for i in result.fetchall()}
-    # Now we copy each instance to the staging bucket
+    # Now we concurrently copy the instances to the staging bucket
     start = time.time()
+    # The copy threads are passed uuids, not ORM objects
+    instances = {instance.uuid: instance for instance in series.instances if not instance.done}
+    gcs_urls = {uuid: src_instance_metadata[instance.sop_instance_uid]['gcs_url'] \
+                for uuid, instance in instances.items()}
+    results = copy_gcs_to_gcs_concurrently(args, client, args.prestaging_idc_bucket, series.uuid, gcs_urls)
+    copied = [instances[uuid] for uuid in results]
+    # The rewrite responses are the series' checksum manifest. Validate each copy against its IDC hash.
+    manifest = {uuid: (hash, size) for uuid, (size, hash) in results.items()}
+    for instance in copied:
+        instance.hash = src_instance_metadata[instance.sop_instance_uid]['hash']
+        instance.size = results[instance.uuid][0]
+    try:
+        validate_series_in_gcs(args, client.bucket(args.prestaging_idc_bucket), series, manifest, copied)
+    except RuntimeError:
+        errlogger.error("       p%s: Copy files to GCS failed for %s/%s/%s/%s", args.pid,
+                        collection.collection_id, patient.submitter_case_id, study.study_instance_uid,
+                        series.series_instance_uid)
+        # Copy failed. Return without marking all instances done. This will be prevent the series from being done.
+        return
     total_size = 0
-    for instance in series.instances:
-        if not instance.done:
-            # Copy the instance and validate the hash
-            instance.hash = src_instance_metadata[instance.sop_instance_uid]['hash']
-            instance.size, hash = copy_gcs_to_gcs(args, client, args.prestaging_idc_bucket, series, instance, src_instance_metadata[instance.sop_instance_uid]['gcs_url'])
-            if hash != instance.hash:
-                errlogger.error("       p%s: Copy files to GCS failed for %s/%s/%s/%s/%s", args.pid,
-                                collection.collection_id, patient.submitter_case_id, study.study_instance_uid,
-                                series.series_instance_uid, instance.sop_instance_uid)
-                # Copy failed. Return without marking all instances done. This will be prevent the series from being done.
-                return
-            total_size += instance.size
-            instance.done = True
-    progresslogger.debug("        p%s: Series %s: instances: %s, gigabytes: %.2f, rate: %.2fMB/s",
+    for instance in copied:
+        total_size += instance.size
+        instance.done = True
+    duration = time.time() - start
+    progresslogger.info("        p%s: Series %s: instances: %s, copied: %s, gigabytes: %.2f, rate: %.2fMB/s",
                      args.pid, series.series_instance_uid,
-                     len(series.instances),
+                     len(series.instances), len(copied),
                      total_size/(2**30),
-                     (total_size/(time.time() - start))/(2**20)
-                     )
\ No newline at end of file
+                     (total_size/duration if duration else 0)/(2**20)
+                     )
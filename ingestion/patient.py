@@ -20,7 +20,7 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
 from idc.models import Patient, Study
 from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped
-from ingestion.study import clone_study, build_study, retire_study
+from ingestion.study import clone_study, build_study, retire_study, expand_study, build_seriess_concurrently
 from python_settings import settings
 
 # Return a dictionary of the dois and urls of all series in the patient
@@ -124,6 +124,8 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
         patient.studies.append(new_study)
         progresslogger.debug  ('    p%s: Study %s is new',  args.pid, new_study.study_instance_uid)
 
+    all_sources.prefetch_study_hashes(collection.collection_id,
+        [study.study_instance_uid for study in existing_objects], skipped)
     for study in existing_objects:
         idc_hashes = study.hashes
 
@@ -164,6 +166,7 @@ def expand_patient(sess, args, all_sources, version, collection, patient):
             # Shouldn't be needed if the previous version is done
             study.done = True
             study.expanded = True
+            all_sources.invalidate_src_hashes('study', study.study_instance_uid)
             progresslogger.info  ('    p%s: Study %s unchanged',  args.pid, study.study_instance_uid)
 
     for study in retired_objects:
@@ -180,10 +183,26 @@ def build_patient(sess, args, all_sources, patient_index, version, collection, p
         begin = time.time()
         successlogger.debug("  p%s: Expand Patient %s, %s", args.pid, patient.submitter_case_id, patient_index)
         if not patient.expanded:
+            if args.async_expansion:
+                all_sources.prefetch_patient_tree(collection, patient,
+                    is_skipped(args.skipped_collections, collection.collection_id))
             expand_patient(sess, args, all_sources, version, collection, patient)
             successlogger.info("  p%s: Expanded Patient %s, %s, %s studies, expand_time: %s, %s", args.pid, patient.submitter_case_id, patient_index, len(patient.studies), time.time()-begin, time.asctime())
 
         dois_urls_licenses = get_dois_urls_licenses(args, all_sources, collection.collection_id, patient.submitter_case_id)
+        if args.series_threads:
+            # Expand the unbuilt studies, then build all their series concurrently. build_study()
+            # then only has to validate each study.
+            studies = [study for study in patient.studies if not study.done]
+            for study in studies:
+                if not study.expanded:
+                    expand_study(sess, args, all_sources, version, collection, patient, study, dois_urls_licenses)
+            build_seriess_concurrently(sess, args, version, collection, patient, studies)
+            # The series were validated with the threads' own sources, so drop the series hashes
+            # that expand_study() memoized here
+            for study in studies:
+                for series in study.seriess:
+                    all_sources.invalidate_src_hashes('series', series.series_instance_uid)
         for study in patient.studies:
             study_index = f'{patient.studies.index(study) + 1} of {len(patient.studies)}'
             if not study.done:
@@ -210,7 +229,7 @@ def build_patient(sess, args, all_sources, patient_index, version, collection, p
                 patient.done = True
                 sess.commit()
                 duration = str(timedelta(seconds=(time.time() - begin)))
-                successlogger.info("  p%s: Built Patient %s, %s, in %s, %s", args.pid, patient.submitter_case_id, patient_index, duration, time.asctime())
+                successlogger.info("  p%s: Built Patient %s, %s, in %s, %s, %s", args.pid, patient.submitter_case_id, patient_index, duration, time.asctime(), all_sources.src_hash_stats())
     except Exception as exc:
         errlogger.exception('  p%s build_patient failed: %s', args.pid, exc)
         # errlogger.error('  p%s build_patient failed: %s', args.pid, exc)
@@ -18,12 +18,16 @@ import time
 from datetime import datetime, timedelta
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
-from idc.models import Series, Instance, instance_source
-from ingestion.instance import clone_instance, build_instances_idc, build_instances_tcia
+from idc.models import Series, Instance, instance_source, series_instance
+from sqlalchemy import insert
+from ingestion.instance import clone_instance, build_instances_idc, build_instances_tcia, build_instances_tcia_stream
 from ingestion.utilities.utils import is_skipped
 from python_settings import settings
 
 
+# Maximum number of rows in a multi-row INSERT of new instances
+INSERT_BATCH = 10000
+
 # successlogger = logging.getLogger('root.success')
 # progresslogger = logging.getLogger('root.progress')
 # errlogger = logging.getLogger('root.err')
@@ -77,30 +81,17 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
         # An object in IDC will continue to exist if any non-skipped source has the object or IDC's object has a
         # skipped source. I.E. if an object has a skipped source then, we can't ask the source about it so assume
         # it exists.
-        existing_objects = [obj for id, obj in idc_objects.items() \
-            if id in instances or (obj.source and skipped[obj.source.value])]
+        existing_ids = set(id for id, obj in idc_objects.items() \
+            if id in instances or (obj.source and skipped[obj.source.value]))
+        existing_objects = [obj for id, obj in idc_objects.items() if id in existing_ids]
         # An object in IDC is retired if it no longer exists in IDC
         retired_objects = [obj for id, obj in idc_objects.items() \
-               if not obj in existing_objects ]
-
-    for instance in sorted(new_objects):
-        new_instance = Instance()
-        new_instance.sop_instance_uid=instance
-        new_instance.uuid=str(uuid4())
-        new_instance.size=0
-        new_instance.revised=True
-        new_instance.done=False
-        new_instance.is_new=True
-        new_instance.expanded=False
-        new_instance.init_idc_version=settings.CURRENT_VERSION
-        new_instance.rev_idc_version=settings.CURRENT_VERSION
-        new_instance.source = instances[instance]
-        new_instance.hash = None
-        new_instance.timestamp = datetime.utcnow()
-        new_instance.final_idc_version = 0
-        series.instances.append(new_instance)
-        progresslogger.debug('        p%s: Instance %s is new', args.pid, new_instance.sop_instance_uid)
+               if not id in existing_ids ]
 
+    # All instances in a series are from a single source
+    if existing_objects:
+        all_sources.prefetch_instance_hashes([instance.sop_instance_uid for instance in existing_objects],
+            instances[existing_objects[0].sop_instance_uid])
     for instance in existing_objects:
         idc_hash = instance.hash
         src_hash = all_sources.src_instance_hashes(instance.sop_instance_uid, instances[instance.sop_instance_uid])
@@ -139,11 +130,45 @@ def expand_series(sess, args, all_sources, version, collection, patient, study,
         instance.final_idc_version = settings.PREVIOUS_VERSION
         series.instances.remove(instance)
 
+    # Flush the revisions before the new instances are inserted behind the ORM's back
+    sess.flush()
+    insert_new_instances(sess, args, series, sorted(new_objects), instances)
+
     series.expanded = True
     sess.commit()
     return 0
 
 
+# Insert new instances, and their series_instance rows, in multi-row INSERTs rather than
+# through ORM objects that are flushed one by one. The series' instances collection is
+# expired so that it is reloaded with the new instances.
+def insert_new_instances(sess, args, series, sop_instance_uids, instances):
+    timestamp = datetime.utcnow()
+    for batch_start in range(0, len(sop_instance_uids), INSERT_BATCH):
+        rows = [
+            dict(
+                sop_instance_uid=sop_instance_uid,
+                uuid=str(uuid4()),
+                size=0,
+                revised=True,
+                done=False,
+                is_new=True,
+                expanded=False,
+                init_idc_version=settings.CURRENT_VERSION,
+                rev_idc_version=settings.CURRENT_VERSION,
+                source=instance_source[instances[sop_instance_uid]],
+                hash=None,
+                timestamp=timestamp,
+                final_idc_version=0,
+                excluded=False
+            ) for sop_instance_uid in sop_instance_uids[batch_start:batch_start + INSERT_BATCH]]
+        sess.execute(insert(Instance), rows)
+        sess.execute(insert(series_instance),
+            [dict(series_uuid=series.uuid, instance_uuid=row['uuid']) for row in rows])
+    progresslogger.debug('        p%s: Series %s has %s new instances', args.pid, series.series_instance_uid, len(sop_instance_uids))
+    sess.expire(series, ['instances'])
+
+
 def build_series(sess, args, all_sources, series_index, version, collection, patient, study, series):
     try:
         begin = time.time()
@@ -161,7 +186,11 @@ def build_series(sess, args, all_sources, series_index, version, collection, pat
 
         if not all(instance.done for instance in series.instances):
             if series.sources.tcia:
-                build_instances_tcia(sess, args, collection, patient, study, series)
+                if args.stream_tcia:
+                    # Stream instances from NBIA to the prestaging bucket without using local disk
+                    build_instances_tcia_stream(sess, args, collection, patient, study, series)
+                else:
+                    build_instances_tcia(sess, args, collection, patient, study, series)
             if series.sources.idc:
                 # Get instance data from idc DB table/ GCS bucket.
                 build_instances_idc(sess, args, collection, patient, study, series)
@@ -179,6 +208,7 @@ def build_series(sess, args, all_sources, series_index, version, collection, pat
             src_hashes = all_sources.src_series_hashes(collection.collection_id, series.series_instance_uid, skipped)
             revised = [(x != y) and not z for x, y, z in \
                        zip(idc_hashes[:-1], src_hashes, skipped)]
+            all_sources.invalidate_src_hashes('series', series.series_instance_uid)
             if any(revised):
                 # raise Exception('Hash match failed for series %s', series.series_instance_uid)
                 errlogger.error('Hash match failed for series %s', series.series_instance_uid)
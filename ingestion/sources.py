@@ -14,10 +14,12 @@
 # limitations under the License.
 #
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from utilities.tcia_helpers import  get_hash, get_TCIA_studies_per_patient, get_TCIA_patients_per_collection,\
+from utilities.tcia_helpers import  get_TCIA_studies_per_patient, get_TCIA_patients_per_collection,\
     get_TCIA_series_per_study, get_TCIA_instance_uids_per_series, get_collection_values_and_counts,\
-    get_instance_hash, get_access_token
+    get_nbia_client
 from idc.models  import IDC_Collection, IDC_Patient, IDC_Study, IDC_Series, IDC_Instance, instance_source
 from sqlalchemy import select
 from ingestion.utilities.get_collection_dois_urls_licenses import get_patient_dois_idc, \
@@ -27,43 +29,92 @@ from utilities.logging_config import successlogger, progresslogger, errlogger, r
 # rootlogger = logging.getLogger('root')
 # errlogger = logging.getLogger('root.err')
 
+# Maximum number of concurrent NBIA hash requests per process
+HASH_REQUESTS = 8
+# Maximum number of UIDs per IDC hash prefetch query
+HASH_QUERY_BATCH = 1000
+
 
 class Source:
     def __init__(self, source_id):
         self.source_id = source_id; # ID for indexing a "sources" column in PSQL
         self.nbia_server = 'NBIA' # Default. Set to 'NLST' only when getting NLST radiology
 
+    # Get, in bulk, the hashes of objects whose hashes are about to be checked one by one.
+    # Sources for which per-object hash lookups are expensive override these.
+    def prefetch_patient_hashes(self, collection_id, submitter_case_ids):
+        return
+
+    def prefetch_study_hashes(self, collection_id, study_instance_uids):
+        return
+
+    def prefetch_series_hashes(self, series_instance_uids):
+        return
+
+    def prefetch_instance_hashes(self, sop_instance_uids):
+        return
+
 
 class TCIA(Source):
-    def __init__(self, pid, sess, access, skipped_collections, lock):
+    def __init__(self, pid, sess, skipped_collections):
         super().__init__(instance_source['tcia'].value)
         self.source = instance_source.tcia
-        # self.access_token, self.refresh_token = get_access_token()
         self.pid = pid
         self.sess = sess
-        self.access = access
         self.skipped_collections = skipped_collections
-        self.lock = lock
-
-    def get_hash(self, request_data, access_token=None, refresh_token=None):
-        self.lock.acquire()
+        # Connection-pooled NBIA client. It caches and refreshes its own access token.
+        self.nbia_client = get_nbia_client(self.nbia_server)
+        # Hashes gotten by prefetch_*_hashes() and not yet used, indexed by (level, UID)
+        self.hashes = {}
+        # Listings gotten by the concurrent expansion of a patient and not yet used, indexed by (level, parent UID)
+        self.listings = {}
+        # Bounds the number of concurrent hash requests
+        self.hash_semaphore = threading.BoundedSemaphore(HASH_REQUESTS)
+
+    # Returns None if the hash can't be gotten, including when the request raises
+    def get_hash(self, request_data):
         try:
-            # result = get_hash(request_data, self.access_token)
-            result = get_hash(request_data, self.access[0])
-            if result.status_code == 401:
-                # Refresh the token and try once more to get the hash
-                # errlogger.error('p%s Refreshing access token %s, refresh token %s at %s', self.pid, self.access[0], self.access[1], time.asctime(time.localtime()))
-                # self.access[0], self.access[1] = refresh_access_token(self.access[1])
-                self.access[0], self.access[1] = get_access_token()
-                # errlogger.error('p%s After refresh, token %s, refresh token %s', self.pid, self.access[0], self.access[1])
-                result = get_hash(request_data, self.access[0])
-                if result.status_code != 200:
-                    result = None
-            elif result.status_code != 200:
-                result = None
-        finally:
-            self.lock.release()
-            return result
+            with self.hash_semaphore:
+                result = self.nbia_client.get_hash(request_data)
+        except Exception as exc:
+            errlogger.error('p%s: get_hash %s failed: %s', self.pid, request_data, exc)
+            return None
+        if result.status_code != 200:
+            result = None
+        return result
+
+    # Concurrently get the hashes of some objects of a level, caching them by UID.
+    # If the hash of some object can't be gotten, it is not cached; the object's
+    # src_*_hash() call then requests it again and handles the failure.
+    def prefetch_hashes(self, level, uids, get_hash):
+        def prefetch(uid):
+            if (level, uid) in self.hashes:
+                return
+            try:
+                result = get_hash(uid)
+            except Exception as exc:
+                progresslogger.info('p%s: Prefetch of %s %s hash failed: %s', self.pid, level, uid, exc)
+                return
+            if result:
+                self.hashes[(level, uid)] = result.content.decode()
+
+        with ThreadPoolExecutor(max_workers=HASH_REQUESTS) as executor:
+            list(executor.map(prefetch, uids))
+
+    def prefetch_patient_hashes(self, collection_id, submitter_case_ids):
+        self.prefetch_hashes('patient', submitter_case_ids,
+            lambda submitter_case_id: self.get_hash({'Collection':collection_id, 'PatientID': submitter_case_id}))
+
+    def prefetch_study_hashes(self, collection_id, study_instance_uids):
+        self.prefetch_hashes('study', study_instance_uids,
+            lambda study_instance_uid: self.get_hash({'StudyInstanceUID': study_instance_uid}))
+
+    def prefetch_series_hashes(self, series_instance_uids):
+        self.prefetch_hashes('series', series_instance_uids,
+            lambda series_instance_uid: self.get_hash({'SeriesInstanceUID': series_instance_uid}))
+
+    def prefetch_instance_hashes(self, sop_instance_uids):
+        self.prefetch_hashes('instance', sop_instance_uids, self.get_instance_hash)
 
     ###-------------------Versions-----------------###
 
@@ -110,6 +161,9 @@ class TCIA(Source):
 
 
     def src_patient_hash(self, collection_id, submitter_case_id):
+        # A prefetched hash is used once, so that the cache doesn't grow for the whole run
+        if ('patient', submitter_case_id) in self.hashes:
+            return self.hashes.pop(('patient', submitter_case_id))
         try:
             result = self.get_hash({'Collection':collection_id, 'PatientID': submitter_case_id})
         except Exception as exc:
@@ -143,11 +197,16 @@ class TCIA(Source):
     ###-------------------Studies-----------------###
 
     def studies(self, patient):
+        if ('studies', patient.submitter_case_id) in self.listings:
+            return self.listings.pop(('studies', patient.submitter_case_id))
         studies = [study['StudyInstanceUID'] for study in get_TCIA_studies_per_patient(patient.collections[0].collection_id, patient.submitter_case_id, self.nbia_server)]
         return studies
 
 
     def src_study_hash(self, collection_id, study_instance_uid):
+        # A prefetched hash is used once, so that the cache doesn't grow for the whole run
+        if ('study', study_instance_uid) in self.hashes:
+            return self.hashes.pop(('study', study_instance_uid))
         try:
             result = self.get_hash({'StudyInstanceUID': study_instance_uid})
         except Exception as exc:
@@ -163,12 +222,17 @@ class TCIA(Source):
     ###-------------------Series-----------------###
 
     def series(self, study):
+        if ('series', study.study_instance_uid) in self.listings:
+            return self.listings.pop(('series', study.study_instance_uid))
         series = [series['SeriesInstanceUID'] for series in get_TCIA_series_per_study(study.patients[0].collections[0].collection_id, study.patients[0].submitter_case_id, study.study_instance_uid, \
                                          self.nbia_server)]
         return series
 
 
     def src_series_hash(self, series_instance_uid):
+        # A prefetched hash is used once, so that the cache doesn't grow for the whole run
+        if ('series', series_instance_uid) in self.hashes:
+            return self.hashes.pop(('series', series_instance_uid))
         try:
             result = self.get_hash({'SeriesInstanceUID': series_instance_uid})
         except Exception as exc:
@@ -183,11 +247,16 @@ class TCIA(Source):
     ###-------------------Instance-----------------###
 
     def instances(self, collection, series):
+        if ('instances', series.series_instance_uid) in self.listings:
+            return self.listings.pop(('instances', series.series_instance_uid))
         instances = [instance['SOPInstanceUID'] for instance in get_TCIA_instance_uids_per_series(collection.collection_id, series.series_instance_uid, self.nbia_server)]
         return instances
 
 
     def src_instance_hash(self, sop_instance_uid):
+        # A prefetched hash is used once, so that the cache doesn't grow for the whole run
+        if ('instance', sop_instance_uid) in self.hashes:
+            return self.hashes.pop(('instance', sop_instance_uid))
         try:
             result = self.get_instance_hash(sop_instance_uid)
         except Exception as exc:
@@ -199,24 +268,12 @@ class TCIA(Source):
             errlogger.info('get_hash failed for instance %s', sop_instance_uid)
             raise Exception('get_hash failed for instance %s', sop_instance_uid)
 
-    def get_instance_hash(self, sop_instance_uid, access_token=None, refresh_token=None):
-        self.lock.acquire()
-        try:
-            # result = get_instance_hash(sop_instance_uid, self.access_token)
-            result = get_instance_hash(sop_instance_uid, self.access[0])
-            if result.status_code == 401:
-                # # Refresh the token and try once more to get the hash
-                # self.access_token, self.refresh_token = refresh_access_token(self.refresh_token)
-                # Get a new access token
-                self.access_token, self.refresh_token = get_access_token()
-                result = get_instance_hash(sop_instance_uid, self.access_token)
-                if result.status_code != 200:
-                    result = None
-            elif result.status_code != 200:
-                result = None
-        finally:
-            self.lock.release()
-            return result
+    def get_instance_hash(self, sop_instance_uid):
+        with self.hash_semaphore:
+            result = self.nbia_client.get_instance_hash(sop_instance_uid)
+        if result.status_code != 200:
+            result = None
+        return result
 
 
 class IDC(Source):
@@ -225,6 +282,48 @@ class IDC(Source):
         self.source = instance_source.idc
         self.sess = sess
         self.skipped_collections = skipped_collections
+        # Hashes gotten by prefetch_*_hashes() and not yet used, indexed by (level, UID)
+        self.hashes = {}
+        # The (UID, hash) columns of each level
+        self.hash_columns = {
+            'patient': (IDC_Patient.submitter_case_id, IDC_Patient.hash),
+            'study': (IDC_Study.study_instance_uid, IDC_Study.hash),
+            'series': (IDC_Series.series_instance_uid, IDC_Series.hash),
+            'instance': (IDC_Instance.sop_instance_uid, IDC_Instance.hash)
+        }
+
+
+    # Get the hashes of the children of the object being expanded, with one query per
+    # HASH_QUERY_BATCH UIDs. The hashes are cached by UID until they are used.
+    def prefetch_hashes(self, level, uids):
+        uid_column, hash_column = self.hash_columns[level]
+        uids = [uid for uid in uids if (level, uid) not in self.hashes]
+        for i in range(0, len(uids), HASH_QUERY_BATCH):
+            query = select(uid_column, hash_column).where(uid_column.in_(uids[i:i + HASH_QUERY_BATCH]))
+            for row in self.sess.execute(query):
+                self.hashes[(level, row[0])] = row[1]
+
+    def prefetch_patient_hashes(self, collection_id, submitter_case_ids):
+        self.prefetch_hashes('patient', submitter_case_ids)
+
+    def prefetch_study_hashes(self, collection_id, study_instance_uids):
+        self.prefetch_hashes('study', study_instance_uids)
+
+    def prefetch_series_hashes(self, series_instance_uids):
+        self.prefetch_hashes('series', series_instance_uids)
+
+    def prefetch_instance_hashes(self, sop_instance_uids):
+        self.prefetch_hashes('instance', sop_instance_uids)
+
+    # Get the hash of an object. A prefetched hash is used once, so that the cache doesn't
+    # grow for the whole run.
+    def get_hash(self, level, uid):
+        if (level, uid) in self.hashes:
+            return self.hashes.pop((level, uid))
+        uid_column, hash_column = self.hash_columns[level]
+        row = self.sess.execute(select(hash_column).where(uid_column == uid)).fetchone()
+        hash = row[0] if row else ""
+        return hash
 
 
     ###-------------------Collections-----------------###
@@ -242,7 +341,8 @@ class IDC(Source):
 
     def src_collection_hash(self, collection_id):
         query = select(IDC_Collection.hash).where(IDC_Collection.collection_id == collection_id)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
+        row = self.sess.execute(query).fetchone()
+        hash = row.hash if row else ""
         return hash
 
 
@@ -256,8 +356,7 @@ class IDC(Source):
 
     def src_patient_hash(self, collection_id, submitter_case_id):
         try:
-           query = select(IDC_Patient.hash).where(IDC_Patient.submitter_case_id == submitter_case_id)
-           hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
+           hash = self.get_hash('patient', submitter_case_id)
         except Exception as exc:
             errlogger.error(f'Exception in src_patient_hash: {exc}')
             breakpoint()
@@ -291,8 +390,7 @@ class IDC(Source):
 
 
     def src_study_hash(self, collection_id, study_instance_uid):
-        query = select(IDC_Study.hash).where(IDC_Study.study_instance_uid == study_instance_uid)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
+        hash = self.get_hash('study', study_instance_uid)
         return hash
 
     ###-------------------Series-----------------###
@@ -304,8 +402,7 @@ class IDC(Source):
 
 
     def src_series_hash(self, series_instance_uid):
-        query = select(IDC_Series.hash).where(IDC_Series.series_instance_uid == series_instance_uid)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
+        hash = self.get_hash('series', series_instance_uid)
         return hash
 
     ###-------------------Instances-----------------###
@@ -316,7 +413,6 @@ class IDC(Source):
         return instances
 
     def src_instance_hash(self, sop_instance_uid):
-        query = select(IDC_Instance.hash).where(IDC_Instance.sop_instance_uid == sop_instance_uid)
-        hash = self.sess.execute(query).fetchone().hash if self.sess.execute(query).fetchone() else ""
+        hash = self.get_hash('instance', sop_instance_uid)
         return hash
 
@@ -16,12 +16,18 @@
 
 
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
-from idc.models import Study, Series, instance_source
+from idc.models import Version, Collection, Patient, Study, Series, instance_source
 from ingestion.utilities.utils import accum_sources, get_merkle_hash, is_skipped
 from ingestion.series import clone_series, build_series, retire_series
+from ingestion.all_sources import All
+from utilities.sqlalchemy_helpers import sa_engine, ENGINE_POOL_SIZE
+from sqlalchemy.orm import Session
+from copy import copy
 
 from python_settings import settings
 
@@ -114,6 +120,8 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
         study.seriess.append(new_series)
         progresslogger.debug('      p%s:Series %s new', args.pid, new_series.series_instance_uid)
 
+    all_sources.prefetch_series_hashes(collection.collection_id,
+        [series.series_instance_uid for series in existing_objects], skipped)
     for series in existing_objects:
         idc_hashes = series.hashes
 
@@ -153,6 +161,7 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
             # Shouldn't be needed if the previous version is done
             series.done = True
             series.expanded = True
+            all_sources.invalidate_src_hashes('series', series.series_instance_uid)
             progresslogger.debug('      p%s: Series %s unchanged',  args.pid, series.series_instance_uid)
 
     for series in retired_objects:
@@ -163,6 +172,65 @@ def expand_study(sess, args, all_sources, version, collection, patient, study, d
     sess.commit()
     return
 
+# Build the unbuilt series of some expanded studies of a patient in up to args.series_threads
+# threads. A session isn't thread safe, so each thread has its own session, from the process's
+# shared engine, and its own sources and copy of args, in which it reloads the objects that it
+# needs. The keys of those objects are read here, since the threads must not touch the caller's
+# session. When all the series have been built, the caller's session is expired so that it sees
+# what the threads committed.
+def build_seriess_concurrently(sess, args, version, collection, patient, studies):
+    version_id = version.version
+    collection_uuid = collection.uuid
+    patient_uuid = patient.uuid
+    local = threading.local()
+    sessions = []
+    sessions_lock = threading.Lock()
+    engine = sa_engine()
+
+    def build(series_index, study_uuid, series_uuid):
+        if not hasattr(local, 'sess'):
+            local.sess = Session(engine)
+            with sessions_lock:
+                sessions.append(local.sess)
+            local.args = copy(args)
+            local.all_sources = All(args.pid, local.sess, settings.CURRENT_VERSION, args.access,
+                              args.skipped_tcia_collections, args.skipped_idc_collections, threading.Lock())
+        thread_sess = local.sess
+        try:
+            build_series(thread_sess, local.args, local.all_sources, series_index,
+                thread_sess.get(Version, version_id), thread_sess.get(Collection, collection_uuid),
+                thread_sess.get(Patient, patient_uuid), thread_sess.get(Study, study_uuid),
+                thread_sess.get(Series, series_uuid))
+        except Exception:
+            thread_sess.rollback()
+            raise
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(args.series_threads, ENGINE_POOL_SIZE)) as executor:
+            futures = []
+            for study in studies:
+                for series_number, series in enumerate(study.seriess):
+                    if not series.done:
+                        series_index = f'{series_number + 1} of {len(study.seriess)}'
+                        futures.append(executor.submit(build, series_index, study.uuid, series.uuid))
+            exceptions = [future.exception() for future in futures if future.exception()]
+    finally:
+        # Return the threads' connections to the engine's pool
+        for thread_sess in sessions:
+            thread_sess.close()
+
+    # Merge what the threads committed
+    sess.expire_all()
+    for study in studies:
+        for series in study.seriess:
+            # Verify that source is consistent
+            if series.done and ((series.hashes[instance_source.tcia.value] == "" and series.sources.tcia == True) or \
+                    (series.hashes[instance_source.idc.value] == "" and series.sources.idc == True)):
+                errlogger.error('      p%s: Series %s hashes are inconsistent with its sources', args.pid, series.series_instance_uid)
+    if exceptions:
+        raise exceptions[0]
+
+
 # def build_study(sess, args, all_sources, study_index, version, collection, patient, study, data_collection_doi_url, analysis_collection_dois):
 def build_study(sess, args, all_sources, study_index, version, collection, patient, study, dois_urls_licenses):
 
@@ -196,6 +264,7 @@ def build_study(sess, args, all_sources, study_index, version, collection, patie
             src_hashes = all_sources.src_study_hashes(collection.collection_id, study.study_instance_uid, skipped)
             revised = [(x != y) and not z for x, y, z in \
                        zip(idc_hashes[:-1], src_hashes, skipped)]
+            all_sources.invalidate_src_hashes('study', study.study_instance_uid)
             if any(revised):
                 # raise Exception('Hash match failed for study %s', study.study_instance_uid)
                 errlogger.error('Hash match failed for study %s', study.study_instance_uid)
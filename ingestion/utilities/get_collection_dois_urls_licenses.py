@@ -25,16 +25,16 @@ import logging
 from utilities.logging_config import errlogger
 
 logger = logging.getLogger(__name__)
-from utilities.tcia_helpers import get_internal_series_ids, series_drill_down, get_TCIA_series_metadata, \
-    get_license_info
+from utilities.tcia_helpers import get_nbia_client
 from idc.models import IDC_Collection, IDC_Patient, IDC_Study, IDC_Series
 from python_settings import settings
 
 
 def get_dois_tcia(collection, patient="", third_party="no", server=""):
     series_dois = {}
+    nbia_client = get_nbia_client(server)
     try:
-        internal_ids = get_internal_series_ids(collection, patient, third_party, server=server)
+        internal_ids = nbia_client.get_internal_series_ids(collection, patient, third_party)
     except Exception as exc:
         print(f'Exception in get_analysis_collection_dois_tcia {exc}')
         logger.error('Exception in get_analysis_collection_dois_tcia %s', exc)
@@ -43,7 +43,7 @@ def get_dois_tcia(collection, patient="", third_party="no", server=""):
         seriesIDs = []
         for study in subject["studyIdentifiers"]:
             seriesIDs.extend(study["seriesIdentifiers"])
-        study_metadata = series_drill_down(seriesIDs, server=server)
+        study_metadata = nbia_client.series_drill_down(seriesIDs)
         for study in study_metadata:
             for series in study["seriesList"]:
                 uri = series["descriptionURI"]
@@ -116,10 +116,12 @@ def get_patient_urls_idc(sess, collection, patient):
 # Get a per-series list of licenses for a patient. This routine finds series in
 # data sourced from TCIA.
 def get_licenses_tcia(collection, patient, third_party="no", server=""):
-    license_types = get_license_info()
+    nbia_client = get_nbia_client(server)
+    # Licenses are only served by the public NBIA server, so get them with a token from that server
+    license_types = get_nbia_client().get_license_info()
     series_licenses = {}
     try:
-        internal_ids = get_internal_series_ids(collection, patient, third_party, server=server)
+        internal_ids = nbia_client.get_internal_series_ids(collection, patient, third_party)
     except Exception as exc:
         print(f'Exception in get_analysis_collection_dois_tcia {exc}')
         logger.error('Exception in get_analysis_collection_dois_tcia %s', exc)
@@ -128,7 +130,7 @@ def get_licenses_tcia(collection, patient, third_party="no", server=""):
         seriesIDs = []
         for study in subject["studyIdentifiers"]:
             seriesIDs.extend(study["seriesIdentifiers"])
-        study_metadata = series_drill_down(seriesIDs)
+        study_metadata = nbia_client.series_drill_down(seriesIDs)
         for study in study_metadata:
             for series in study["seriesList"]:
                 uri = series["descriptionURI"]
@@ -137,7 +139,7 @@ def get_licenses_tcia(collection, patient, third_party="no", server=""):
                     uri = uri.split('doi.org/')[1]
                 seriesUID = series["seriesUID"]
                 series_metadata = \
-                    get_TCIA_series_metadata(seriesUID)
+                    nbia_client.get_series_metadata(seriesUID)
                 if "License URL" in series_metadata:
                     series_licenses[seriesUID] = {
                         "license_url": series_metadata["License URL"],
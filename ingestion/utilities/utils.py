@@ -17,11 +17,16 @@
 import shutil
 import os
 import hashlib
+import mmap
+import random
+import pydicom
+from pydicom.errors import InvalidDicomError
 from base64 import b64decode
 # import logging
 from subprocess import run, STDOUT, DEVNULL
 from google.cloud import storage
-from google.api_core.exceptions import Conflict
+from google.api_core.exceptions import Conflict, NotFound
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from sqlalchemy import and_
 
@@ -45,6 +50,12 @@ def to_webapp(collection_id):
     return collection_id.lower().replace('-','_').replace(' ','_')
 
 BUF_SIZE = 65536
+# Number of concurrent uploads per series when copying a series from disk to GCS
+UPLOAD_THREADS = 16
+# Number of concurrent rewrites per series when copying a series from GCS to GCS
+COPY_THREADS = 32
+# Size of the chunks in which a composite blob is streamed from its source to its destination
+STREAM_CHUNK_SIZE = 32 * 2**20 # A multiple of 256KB, as resumable uploads require
 def md5_hasher(file_path):
     md5 = hashlib.md5()
     with open(file_path, 'rb') as f:
@@ -56,6 +67,28 @@ def md5_hasher(file_path):
     return md5.hexdigest()
 
 
+DICOM_ID_TAGS = ['SOPInstanceUID', 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID']
+# Get the DICOM IDs of an instance. Only the header of the instance is parsed.
+# Returns (SOPInstanceUID, PatientID, StudyInstanceUID, SeriesInstanceUID)
+def get_dicom_ids(fp):
+    reader = pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=DICOM_ID_TAGS)
+    return reader.SOPInstanceUID, reader.PatientID, reader.StudyInstanceUID, reader.SeriesInstanceUID
+
+
+# Get the md5 hash, size and DICOM IDs of a DICOM file from a single read of the file.
+# The file is mmap'd so that the header is parsed from the same pages that are hashed.
+# Returns (md5, size, SOPInstanceUID, PatientID, StudyInstanceUID, SeriesInstanceUID)
+def dicom_file_info(file_path):
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            raise InvalidDicomError(f'{file_path} is empty')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            md5 = hashlib.md5(mm).hexdigest()
+            ids = get_dicom_ids(mm)
+    return (md5, size) + ids
+
+
 # Hash a sorted list of hashes
 # Return "" if the list is empty
 def get_merkle_hash(hashes):
@@ -68,17 +101,6 @@ def get_merkle_hash(hashes):
     else:
         ""
 
-# Validate that instances were received correctly from TCIA
-def validate_hashes(args, collection, patient, study, series, hashes):
-    for instance in hashes:
-        instance = instance.split(',')
-        if md5_hasher(f'{args.dicom_dir}/{series.uuid}/{instance[0]}') != instance[1]:
-            errlogger.error("      p%s: Invalid hash for %s/%s/%s/%s", args.pid,
-            collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.uuid,\
-            instance[0])
-            return False
-    return True
-
 # Remove any instances in a series from a prestaging bucket.
 # Executed when some problem was detected after copy series
 # files to a bucket.
@@ -91,44 +113,98 @@ def rollback_copy_to_prestaging_bucket(client, args, series):
             errlogger.error('p%s: Failed to delete blob %s/%s.dcm during validation rollback',args.pid, series.uuid, instance.uuid)
             raise
 
+# Remove the blobs of a series that were uploaded to a prestaging bucket before a
+# problem was detected. Used when a series is streamed, instance by instance, to the bucket.
+def rollback_blobs_in_prestaging_bucket(args, blobs):
+    for blob in blobs:
+        try:
+            blob.delete()
+        except NotFound:
+            pass
+        except:
+            errlogger.error('p%s: Failed to delete blob %s during validation rollback', args.pid, blob.name)
+            raise
 
-def validate_series_in_gcs(args, collection, patient, study, series):
-    # client = storage.Client(project=settings.DEV_PROJECT)
-    client = storage.Client()
-    # blobs_info = get_series_info(storage_client, args.project, args.staging_bucket)
-    bucket = client.get_bucket(args.prestaging_tcia_bucket)
-    try:
-        for instance in series.instances:
-            blob = bucket.blob(f'{series.uuid}/{instance.uuid}.dcm')
-            blob.reload()
-            assert instance.hash == b64decode(blob.md5_hash).hex()
-            assert instance.size == blob.size
 
+# Record the md5 hash and size of an instance's blob in a series' checksum manifest. The blob's
+# properties are those of the response to the upload or rewrite that wrote it, so recording
+# them doesn't need a reload(). A manifest is a dict of (md5 hash, size) by instance uuid.
+def record_checksum(manifest, instance_uuid, blob):
+    manifest[instance_uuid] = (b64decode(blob.md5_hash).hex(), blob.size)
+
+
+# Validate a series' checksum manifest against the expected (hash, size) of each of its
+# instances, a dict by instance uuid.
+# A fraction, args.gcs_audit_rate, of the blobs are also reloaded to audit the manifest.
+def validate_manifest(args, bucket, series_uuid, expected, manifest):
+    for instance_uuid, checksum in expected.items():
+        if manifest.get(instance_uuid) != checksum:
+            errlogger.error('p%s: GCS validation failed for %s/%s.dcm', args.pid, series_uuid, instance_uuid)
+            raise RuntimeError('p%s: GCS validation failed for %s/%s.dcm', args.pid, series_uuid, instance_uuid)
+    for instance_uuid in expected:
+        if random.random() < args.gcs_audit_rate:
+            blob = bucket.blob(f'{series_uuid}/{instance_uuid}.dcm')
+            blob.reload()
+            if manifest[instance_uuid] != (b64decode(blob.md5_hash).hex(), blob.size):
+                errlogger.error('p%s: GCS audit failed for %s/%s.dcm', args.pid, series_uuid, instance_uuid)
+                raise RuntimeError('p%s: GCS audit failed for %s/%s.dcm', args.pid, series_uuid, instance_uuid)
+
+
+# Validate that the blobs of the instances of a series, by default all its instances, have the
+# hash and size of the instances, as recorded in the series' checksum manifest.
+def validate_series_in_gcs(args, bucket, series, manifest, instances=None):
+    if instances is None:
+        instances = series.instances
+    validate_manifest(args, bucket, series.uuid,
+                      {instance.uuid: (instance.hash, instance.size) for instance in instances}, manifest)
+
+
+# Upload one instance of a series from disk to the prestaging bucket. The client computes
+# the md5 as the file is streamed and checks it against the md5 in the upload response,
+# which is recorded in the series' checksum manifest.
+def copy_instance_to_prestaging_bucket(args, bucket, series_uuid, instance_uuid, manifest):
+    blob = bucket.blob(f'{series_uuid}/{instance_uuid}.dcm')
+    blob.upload_from_filename(f'{args.dicom_dir}/{series_uuid}/{instance_uuid}.dcm', checksum='md5')
+    record_checksum(manifest, instance_uuid, blob)
+    return blob
+
+
+# Copy the series instances downloaded from TCIA/NBIA from disk to the prestaging bucket.
+# Instances are uploaded in-process by a bounded pool of threads that share one client.
+# A client can be passed in, e.g. a fake client in tests; by default the process's shared
+# client is used (storage.Client() honors STORAGE_EMULATOR_HOST).
+# The threads are passed uuids, not ORM objects. The hash and size of each instance are read
+# here, before the threads start.
+def copy_disk_to_prestaging_bucket(args, series, client=None):
+    if not client:
+        client = get_storage_client()
+    bucket = client.bucket(args.prestaging_tcia_bucket)
+    series_uuid = series.uuid
+    series_instance_uid = series.series_instance_uid
+    expected = {instance.uuid: (instance.hash, instance.size) for instance in series.instances}
+    manifest = {}
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+            futures = [executor.submit(copy_instance_to_prestaging_bucket, args, bucket, series_uuid, instance_uuid, manifest) \
+                       for instance_uuid in expected]
+            for future in as_completed(futures):
+                future.result()
+        # Validate the uploads against the hash and size that we computed when the files were received
+        validate_manifest(args, bucket, series_uuid, expected, manifest)
     except Exception as exc:
-        rollback_copy_to_prestaging_bucket(client, args, series)
-        errlogger.error('p%s: GCS validation failed for %s/%s/%s/%s/%s',
-            args.pid, collection.collection_id, patient.submitter_case_id, study.study_instance_uid, series.series_instance_uid, instance.sop_instance_uid)
-        raise exc
+        errlogger.error("\tp%s: Copy to prestage bucket failed for series %s", args.pid, series_instance_uid)
+        rollback_blobs_in_prestaging_bucket(args, [bucket.blob(f'{series_uuid}/{instance_uuid}.dcm') \
+                                                   for instance_uuid in expected])
+        raise RuntimeError("p%s: Copy to prestage bucketfailed for series %s", args.pid, series_instance_uid) from exc
 
 
-# Copy the series instances downloaded from TCIA/NBIA from disk to the prestaging bucket
-def copy_disk_to_prestaging_bucket(args, series):
-    #Do the copy as a subprocess in order to use the gsutil -m option
-    try:
-        # Copy the series to GCS
-        src = f'{args.dicom_dir}/{series.uuid}'
-        dst = f'gs://{args.prestaging_tcia_bucket}'
-        # breakpoint() # Check if -J parameter is still broken
-        result = run(["gsutil", "-m", "-q", "cp", "-r", src, dst], check=True)
-        # result = run(["gcloud", "storage", "--quiet", "cp", "--recursive", src, dst], check=True,
-        #              stdout=DEVNULL, stderr=STDOUT)
-        if result.returncode :
-            errlogger.error('p%s: \tcopy_disk_to_prestaging_bucket failed for series %s', args.pid, series.series_instance_uid)
-            raise RuntimeError('p%s: copy_disk_to_prestaging_bucket failed for series %s', args.pid, series.series_instance_uid)
-        # rootlogger.debug("p%s: Uploaded instances to GCS", args.pid)
-    except Exception as exc:
-        errlogger.error("\tp%s: Copy to prestage bucket failed for series %s", args.pid, series.series_instance_uid)
-        raise RuntimeError("p%s: Copy to prestage bucketfailed for series %s", args.pid, series.series_instance_uid) from exc
+# Upload an instance that is held in a (spooled) file object to the prestaging bucket, and record
+# its checksum from the upload response in the series' checksum manifest.
+def copy_memory_to_prestaging_bucket(args, bucket, series, instance, data, manifest):
+    blob = bucket.blob(f'{series.uuid}/{instance.uuid}.dcm')
+    blob.upload_from_file(data, size=instance.size, checksum='md5')
+    record_checksum(manifest, instance.uuid, blob)
+    return blob
 
 
 def empty_bucket(bucket):
@@ -168,62 +244,81 @@ def copy_disk_to_gcs(args, collection, patient, study, series):
     # Delete the zip file before we copy to GCS so that it is not copied
     os.remove("{}/{}.zip".format(args.dicom_dir, series.uuid))
 
-    # Copy the instances to the staging bucket
+    # Copy the instances to the staging bucket. The uploads are validated against the
+    # md5s and sizes in their responses, rather than by reloading each blob.
     copy_disk_to_prestaging_bucket(args, series)
 
-    # Ensure that they were copied correctly
-    validate_series_in_gcs(args, collection, patient, study, series)
-
     # Delete the series from disk
     shutil.rmtree("{}/{}".format(args.dicom_dir, series.uuid), ignore_errors=True)
 
+# Copy a composite blob such that the resulting blob is a noncomposite blob, which has an md5 hash.
+# The source is streamed straight into a resumable upload of the destination, so nothing is staged
+# on local disk. The upload computes the md5 of the data as it is sent, and fails if it differs from
+# the md5 of the uploaded blob. The upload response populates dst_blob's properties.
 def copy_composite_blob_to_noncomposite_blob(args, src_blob, dst_blob):
-    # We need to copy a composite blob such that the resulting blob is a noncomposite blob
-    # For this purpose, we copy to a local file and then to the destination
-    #Do the copy as a subprocess in order to use the gsutil -m option
     try:
-        # Copy the blob to disk
-        src = f'gs://{src_blob.bucket.name}/{src_blob.name}'
-        dst = f'/mnt/disks/idc-etl/tmp/{src_blob.name}'
-        result = run(["gsutil", "-m", "-q", "cp", "-r", src, dst], check=True)
-        if result.returncode :
-            errlogger.error('p%s: \tcopy_disk_to_prestaging_bucket copy to file failed for %s', args.pid, src_blob.name)
-            raise RuntimeError('p%s: opy_disk_to_prestaging_bucket copy to file failed for %s', args.pid, src_blob.name)
-        src = dst
-        dst = f'gs://{dst_blob.bucket.name}/{dst_blob.name}'
-        result = run(["gsutil", "-m", "-q", "cp", "-r", src, dst], check=True)
-        if result.returncode :
-            errlogger.error('p%s: \tcopy_disk_to_prestaging_bucket copy to gcs failed for %s', args.pid, dst_blob.name)
-            raise RuntimeError('p%s: opy_disk_to_prestaging_bucket copy to gcs failed for %s', args.pid, dst_blob.name)
+        dst_blob.chunk_size = STREAM_CHUNK_SIZE
+        with src_blob.open('rb', chunk_size=STREAM_CHUNK_SIZE) as src:
+            dst_blob.upload_from_file(src, checksum='md5')
     except Exception as exc:
-        errlogger.error("\tp%s: Copy to prestage bucket failed for series %s", args.pid, series.series_instance_uid)
-        raise RuntimeError("p%s: Copy to prestage bucketfailed for series %s", args.pid, series.series_instance_uid) from exc
+        errlogger.error('p%s: \tcopy_composite_blob_to_noncomposite_blob failed for %s', args.pid, dst_blob.name)
+        raise RuntimeError('p%s: copy_composite_blob_to_noncomposite_blob failed for %s', args.pid, dst_blob.name) from exc
+
 
+# A storage client that is shared by all the threads of a process. Clients are not fork safe,
+# so each worker process creates its own.
+_storage_client = None
+_storage_client_pid = None
+def get_storage_client():
+    global _storage_client, _storage_client_pid
+    if _storage_client_pid != os.getpid():
+        _storage_client = storage.Client()
+        _storage_client_pid = os.getpid()
+    return _storage_client
 
 
 # Copy an instance from a source bucket to a destination bucket. Currently used when ingesting IDC sourced data
-# which is placed in some bucket after preparation
-def copy_gcs_to_gcs(args, client, dst_bucket_name, series, instance, gcs_url):
+# which is placed in some bucket after preparation.
+# The response to the final rewrite carries the destination blob's resource, so its md5_hash and
+# size are used without a reload(). A composite destination blob has no md5_hash, and is re-copied.
+# The instance is identified by its and its series' uuids, so that ORM objects aren't passed to
+# the threads of copy_gcs_to_gcs_concurrently().
+def copy_gcs_to_gcs(args, client, dst_bucket_name, series_uuid, instance_uuid, gcs_url):
     # storage_client = args.client
     idc_src_bucket = client.bucket(gcs_url.split('gs://')[1].split('/',1)[0])
     blob_id = gcs_url.split('gs://')[1].split('/',1)[1]
     dst_bucket = client.bucket(dst_bucket_name)
     src_blob = idc_src_bucket.blob(blob_id)
-    dst_blob = dst_bucket.blob(f'{series.uuid}/{instance.uuid}.dcm')
+    dst_blob = dst_bucket.blob(f'{series_uuid}/{instance_uuid}.dcm')
     token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob)
     while token:
         progresslogger.debug('******p%s: Rewrite bytes_rewritten %s, total_bytes %s', args.pid, bytes_rewritten, total_bytes)
         token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob, token=token)
-    dst_blob.reload()
     if not dst_blob.md5_hash:
         # This is like a composite object. Copy it so that the resulting object is noncomposite
-
         copy_composite_blob_to_noncomposite_blob(args, src_blob, dst_blob)
-        dst_blob = dst_bucket.blob(f'{series.uuid}/{instance.uuid}.dcm')
-        dst_blob.reload()
     return dst_blob.size, b64decode(dst_blob.md5_hash).hex()
 
 
+# Copy instances of a series from their IDC source buckets to a destination bucket, with up to
+# COPY_THREADS rewrites in flight. gcs_urls is a dictionary of gcs_url by instance uuid.
+# Returns a dictionary of (size, md5 hash) by instance uuid. Only uuids are passed to the threads;
+# the caller maps the results back to its ORM objects.
+def copy_gcs_to_gcs_concurrently(args, client, dst_bucket_name, series_uuid, gcs_urls):
+    results = {}
+    with ThreadPoolExecutor(max_workers=COPY_THREADS) as executor:
+        futures = {executor.submit(copy_gcs_to_gcs, args, client, dst_bucket_name, series_uuid, instance_uuid, gcs_url): instance_uuid \
+                   for instance_uuid, gcs_url in gcs_urls.items()}
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
 # The sources of a parent (that is not a series) is the source-wise OR of its children
 def accum_sources(parent, children):
     sources = children[0].sources
@@ -20,7 +20,7 @@ from utilities.logging_config import successlogger, progresslogger, errlogger
 from uuid import uuid4
 from idc.models import instance_source, Version, Collection
 from ingestion.utilities.utils import accum_sources, is_skipped
-from ingestion.collection import clone_collection, build_collection, retire_collection
+from ingestion.collection import clone_collection, build_collection, build_collections, retire_collection
 from egestion.egest import egest_version
 
 from python_settings import settings
@@ -188,6 +188,7 @@ def expand_version(sess, args, all_sources, version):
             # Shouldn't be needed if the previous version is done
             collection.done = True
             collection.expanded = True
+            all_sources.invalidate_src_hashes('collection', collection.collection_id)
             progresslogger.info('p%s: Collection %s unchanged', args.pid, collection.collection_id)
 
     for collection in retired_objects:
@@ -229,13 +230,16 @@ def build_version(sess, args, all_sources, version):
         expand_version(sess, args, all_sources, version)
     idc_collections = sorted(version.collections, key=lambda collection: collection.collection_id)
     progresslogger.info("p%s: Expanded Version %s; %s collections", args.pid, settings.CURRENT_VERSION, len(idc_collections))
-    for collection in idc_collections:
-        collection_index = f'{idc_collections.index(collection) + 1} of {len(idc_collections)}'
-        if not collection.done:
-            build_collection(sess, args, all_sources, collection_index, version, collection)
-            pass
-        else:
-            progresslogger.info("p%s: Collection %s, %s, previously built", args.pid, collection.collection_id, collection_index)
+    if args.num_processes==0:
+        for collection in idc_collections:
+            collection_index = f'{idc_collections.index(collection) + 1} of {len(idc_collections)}'
+            if not collection.done:
+                build_collection(sess, args, all_sources, collection_index, version, collection)
+            else:
+                progresslogger.info("p%s: Collection %s, %s, previously built", args.pid, collection.collection_id, collection_index)
+    else:
+        # A single pool of workers builds the patients of all collections
+        build_collections(sess, args, all_sources, version, idc_collections)
 
     # Check if we are really done
     if all([collection.done for collection in idc_collections]):
@@ -0,0 +1,50 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Add the dirty columns, which gen_hashes.mark_dirty() sets and gen_hashes(dirty_only=True)
+# clears, to the idc_collection/_patient/_study/_series tables of an existing DB.
+# Base.metadata.create_all() does not alter existing tables, so this must be run once, before
+# any code that loads these tables, against a DB created before the columns were added to
+# idc/models.py. It is safe to run again.
+
+import sys
+import argparse
+from sqlalchemy import text
+from utilities.sqlalchemy_helpers import sa_session
+from utilities.logging_config import progresslogger
+
+DDL = [
+    "ALTER TABLE idc_collection ADD COLUMN IF NOT EXISTS dirty boolean DEFAULT false",
+    "ALTER TABLE idc_patient ADD COLUMN IF NOT EXISTS dirty boolean DEFAULT false",
+    "ALTER TABLE idc_study ADD COLUMN IF NOT EXISTS dirty boolean DEFAULT false",
+    "ALTER TABLE idc_series ADD COLUMN IF NOT EXISTS dirty boolean DEFAULT false",
+]
+
+
+def add_dirty_columns():
+    with sa_session() as sess:
+        for statement in DDL:
+            sess.execute(text(statement))
+            progresslogger.info(statement)
+        sess.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    args = parser.parse_args()
+    print("{}".format(args), file=sys.stdout)
+
+    add_dirty_columns()
@@ -14,6 +14,8 @@
 # limitations under the License.
 #
 # Update hierarchical hashes in the WSI tables
+# The dirty columns that mark_dirty() and gen_hashes(dirty_only=True) use must first be added
+# to an existing DB by add_dirty_columns.py.
 import io
 import os
 import sys
@@ -28,51 +30,99 @@ from base64 import b64decode
 from python_settings import settings
 
 from sqlalchemy.orm import Session
-from sqlalchemy import create_engine, update
+from sqlalchemy import create_engine, update, select, func, exists, literal_column
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from google.cloud import storage
 
-def gen_hashes(collection_id=''):
+# The parent->child levels of the idc_* hierarchy, bottom up: (parent, parent key, child foreign key)
+LEVELS = [
+    (IDC_Series, IDC_Series.series_instance_uid, IDC_Instance.series_instance_uid),
+    (IDC_Study, IDC_Study.study_instance_uid, IDC_Series.study_instance_uid),
+    (IDC_Patient, IDC_Patient.submitter_case_id, IDC_Study.submitter_case_id),
+    (IDC_Collection, IDC_Collection.collection_id, IDC_Patient.collection_id),
+]
+
+
+# Keys of the objects of a level that are in some collection
+def keys_in_collection(model, collection_id):
+    if model is IDC_Collection:
+        return select(IDC_Collection.collection_id).where(IDC_Collection.collection_id == collection_id)
+    elif model is IDC_Patient:
+        return select(IDC_Patient.submitter_case_id).where(IDC_Patient.collection_id == collection_id)
+    elif model is IDC_Study:
+        return select(IDC_Study.study_instance_uid).where(IDC_Study.submitter_case_id.in_(
+            keys_in_collection(IDC_Patient, collection_id)))
+    else:
+        return select(IDC_Series.series_instance_uid).where(IDC_Series.study_instance_uid.in_(
+            keys_in_collection(IDC_Study, collection_id)))
+
+
+# Recompute the hashes of one level from the hashes of its children in a single UPDATE.
+# md5(string_agg(hash, '' ORDER BY hash COLLATE "C")) is the md5 of the children's hashes
+# concatenated in byte order, which is what get_merkle_hash() computes. As get_merkle_hash()
+# returns None for an empty list, the hash of an object that has no children is set to NULL.
+# If dirty_only, only objects that have been marked dirty by mark_dirty() are recomputed.
+# The dirty flags of the level are then cleared.
+def gen_level_hashes(sess, parent, parent_key, child_key, collection_id='', dirty_only=False):
+    child = child_key.class_
+    children = select(child_key.label('key'),
+            func.md5(func.string_agg(child.hash, aggregate_order_by(literal_column("''"), child.hash.collate('C')))).label('hash'))
+    childless = update(parent).where(~exists().where(child_key == parent_key)).values(hash=None)
+    cleaned = update(parent).where(parent.dirty == True).values(dirty=False)
+    if collection_id:
+        children = children.where(child_key.in_(keys_in_collection(parent, collection_id)))
+        childless = childless.where(parent_key.in_(keys_in_collection(parent, collection_id)))
+        cleaned = cleaned.where(parent_key.in_(keys_in_collection(parent, collection_id)))
+    if dirty_only:
+        children = children.where(child_key.in_(select(parent_key).where(parent.dirty == True)))
+        childless = childless.where(parent.dirty == True)
+    children = children.group_by(child_key).subquery()
+    updated = sess.execute(update(parent).where(parent_key == children.c.key).values(hash=children.c.hash). \
+        execution_options(synchronize_session=False)).rowcount
+    sess.execute(childless.execution_options(synchronize_session=False))
+    sess.execute(cleaned.execution_options(synchronize_session=False))
+    progresslogger.info('%s: %s hashes', parent.__tablename__, updated)
+
+
+# The attribute of each level that is its parent in the idc_* hierarchy
+PARENTS = {
+    IDC_Series: 'study',
+    IDC_Study: 'patient',
+    IDC_Patient: 'collection',
+}
+
+
+# Mark an object and its ancestors as needing their hashes recomputed. Pass the series of a
+# new or changed instance, or the parent of a deleted object, since a deletion changes the
+# hash of the path above it. Marking the whole path means that gen_hashes(dirty_only=True)
+# only has to recompute dirty objects, and can reuse the stored hashes of all other subtrees.
+def mark_dirty(obj):
+    while obj is not None:
+        obj.dirty = True
+        obj = getattr(obj, PARENTS[type(obj)]) if type(obj) in PARENTS else None
+
+
+# Recompute the series, study, patient and collection hashes of one or all collections,
+# level by level, in the DB. If dirty_only, only the hashes of dirty objects are recomputed.
+def gen_hashes(collection_id='', dirty_only=False):
     sql_uri = f'postgresql+psycopg2://{settings.CLOUD_USERNAME}:{settings.CLOUD_PASSWORD}@{settings.CLOUD_HOST}:{settings.CLOUD_PORT}/{settings.CLOUD_DATABASE}'
     # sql_engine = create_engine(sql_uri, echo=True)
     sql_engine = create_engine(sql_uri)
 
     with Session(sql_engine) as sess:
-        if collection_id:
-             collections = sess.query(IDC_Collection).filter(IDC_Collection.collection_id==collection_id)
-        else:
-            collections = sess.query(IDC_Collection).all()
-        n = 0
-        for collection in collections:
-            for patient in collection.patients:
-                for study in patient.studies:
-                    for series in study.seriess:
-                        hashes = [instance.hash for instance in series.instances]
-                        series.hash = get_merkle_hash(hashes)
-                        progresslogger.info('\t\t\tseries hash %s', series.series_instance_uid)
-                    hashes = [series.hash for series in study.seriess]
-                    study.hash = get_merkle_hash(hashes)
-                    progresslogger.info('\t\tstudy hash %s', study.study_instance_uid)
-                hashes = [study.hash for study in patient.studies]
-                patient.hash = get_merkle_hash(hashes)
-                progresslogger.info('\tpatient hash %s', patient.submitter_case_id)
-                n += 1
-                if not n%100:
-                    sess.commit()
-
-            hashes = [patient.hash for patient in collection.patients]
-            collection.hash = get_merkle_hash(hashes)
-            progresslogger.info('Collection hash %s', collection.collection_id)\
-
+        for parent, parent_key, child_key in LEVELS:
+            gen_level_hashes(sess, parent, parent_key, child_key, collection_id, dirty_only)
         sess.commit()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--version', default=settings.CURRENT_VERSION)
     parser.add_argument('--collection', default='NLST', help='If not null, gen hash of this collection, else all collections')
+    parser.add_argument('--dirty_only', type=bool, default=False, help='Only recompute the hashes of objects that are marked dirty')
 
     args = parser.parse_args()
     print("{}".format(args), file=sys.stdout)
     args.client=storage.Client()
 
-    gen_hashes(args.collection)
+    gen_hashes(args.collection, args.dirty_only)
 
@@ -24,13 +24,13 @@
 # gcsfuse mount point
 
 from idc.models import Base, IDC_Collection, IDC_Patient, IDC_Study, IDC_Series, IDC_Instance, Collection, Patient
-from gen_hashes import gen_hashes
+from gen_hashes import gen_hashes, mark_dirty
 from utilities.logging_config import successlogger, errlogger, progresslogger
 from base64 import b64decode
 from python_settings import settings
 from validate_analysis_result import validate_analysis_result
 from validate_original_collection import validate_original_collection
-from ingestion.utilities.utils import md5_hasher
+from ingestion.utilities.utils import md5_hasher, get_dicom_ids
 
 from pydicom import dcmread
 
@@ -50,6 +50,9 @@ def build_instance(client, args, sess, series, instance_id, hash, size, blob_nam
         instance.sop_instance_uid = instance_id
         series.instances.append(instance)
         progresslogger.info(f'\t\t\t\tInstance {blob_name} added')
+    if instance.hash != hash:
+        # The hashes of the instance's ancestors must be recomputed
+        mark_dirty(series)
     instance.idc_version = args.version
     instance.gcs_url = f'gs://{args.src_bucket}/{blob_name}'
     instance.hash = hash
@@ -136,11 +139,8 @@ def prebuild(args):
                     if not blob.name.endswith('DICOMDIR'):
                         with open(f"{args.mount_point}/{blob.name}", 'rb') as f:
                             try:
-                                r = dcmread(f, specific_tags=['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID'], stop_before_pixels=True)
-                                patient_id = r.PatientID
-                                study_id = r.StudyInstanceUID
-                                series_id = r.SeriesInstanceUID
-                                instance_id = r.SOPInstanceUID
+                                # Only the header is read through the mount. The hash and size come from the listing.
+                                instance_id, patient_id, study_id, series_id = get_dicom_ids(f)
                                 if not args.collection_id:
                                     collection_id = sess.query(Collection.collection_id).distinct().join(
                                         Collection.patients). \
@@ -164,7 +164,7 @@ def prebuild(args):
                 exit -1
 
     if args.gen_hashes:
-        gen_hashes(args.collection_id)
+        gen_hashes(args.collection_id, dirty_only=True)
     return
 
 
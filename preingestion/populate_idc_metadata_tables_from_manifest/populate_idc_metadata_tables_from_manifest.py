@@ -24,7 +24,7 @@
 # gcsfuse mount point
 
 from idc.models import Base, IDC_Collection, IDC_Patient, IDC_Study, IDC_Series, IDC_Instance, Collection, Patient
-from preingestion.populate_idc_metadata_tables.gen_hashes import gen_hashes
+from preingestion.populate_idc_metadata_tables.gen_hashes import gen_hashes, mark_dirty
 from utilities.logging_config import successlogger, errlogger, progresslogger
 from base64 import b64decode
 from python_settings import settings
@@ -91,6 +91,9 @@ def build_instance(args, bucket, series, instance_data):
             errlogger.error(f'Failed to get hash/sizeof {blob_name}')
             exit
 
+    if instance.hash != hash:
+        # The hashes of the instance's ancestors must be recomputed
+        mark_dirty(series)
     instance.size = blob.size
     instance.idc_version = args.version
     instance.gcs_url = f'{gcs_url}'
@@ -299,6 +302,11 @@ def prebuild(args):
             if validate_original_collection(args) == -1:
                 exit -1
 
+    if args.gen_hashes:
+        # Recompute the hashes of the paths that the manifest added to or changed
+        gen_hashes(args.collection_id, dirty_only=True)
+    return
+
 
 # if __name__ == '__main__':
 #
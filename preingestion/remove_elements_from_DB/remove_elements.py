@@ -27,6 +27,7 @@ import argparse
 import csv
 from idc.models import Base, IDC_Collection
 from ingestion.utilities.utils import get_merkle_hash, list_skips
+from preingestion.populate_idc_metadata_tables.gen_hashes import mark_dirty
 from utilities.logging_config import successlogger, errlogger, progresslogger
 from python_settings import settings
 from sqlalchemy.orm import Session
@@ -38,6 +39,8 @@ def remove_instance(client, args, sess, series, instance):
     try:
         series.instances.remove(instance)
         sess.delete(instance)
+        # The hashes of the instance's ancestors must be recomputed
+        mark_dirty(series)
         progresslogger.info('\t\t\t\tInstance %s', instance.sop_instance_uid)
         return
     except StopIteration:
@@ -58,6 +61,7 @@ def remove_series(client, args, sess, study, series):
             if len(series.instances) == 0:
                 study.seriess.remove(series)
                 sess.delete(series)
+                mark_dirty(study)
                 progresslogger.info('\t\t\tSeries %s deleted', series.series_instance_uid)
             else:
                 progresslogger.info('\t\t\tSeries %s retained', series.series_instance_uid)
@@ -99,6 +103,7 @@ def remove_study(client, args, sess, patient, study):
         if len(study.seriess) == 0:
             patient.studies.remove(study)
             sess.delete(study)
+            mark_dirty(patient)
             progresslogger.info('\t\tStudy %s deleted', study.study_instance_uid)
         else:
             progresslogger.info('\t\tStudy %s retained', study.study_instance_uid)
@@ -137,6 +142,7 @@ def remove_patient(client, args, sess, collection, patient):
         if len(patient.studies) == 0:
             collection.patients.remove(patient)
             sess.delete(patient)
+            mark_dirty(collection)
             progresslogger.info('\tPatient %s deleted', patient.submitter_case_id)
         else:
             progresslogger.info('\tPatient %s retained', patient.submitter_case_id)
@@ -40,7 +40,7 @@ def prebuild(args):
             if patient := next((patient for patient in collection.patients if patient.submitter_case_id == submitter_case_id),0):
                 remove_patient(client, args, sess, collection, patient)
         sess.commit()
-        gen_hashes(args.collection_id)
+        gen_hashes(args.collection_id, dirty_only=True)
     return
 
 
@@ -0,0 +1,61 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Offline tests of the AIMD controller's latency target
+
+import pytest
+
+pytest.importorskip('python_settings')
+from utilities.concurrency import AIMDController, BASELINE_REQUESTS
+
+
+def run(controller, latency, n):
+    for _ in range(n):
+        controller.acquire()
+        controller.release(latency)
+
+
+def test_grows_without_target():
+    controller = AIMDController(4, maximum=100)
+    run(controller, 10.0, 50)
+    assert controller.limit > 4
+
+
+def test_fixed_target_stops_growth():
+    controller = AIMDController(4, maximum=100, latency_target=1.0)
+    run(controller, 2.0, 50)
+    assert controller.limit == 4
+
+
+def test_baseline_target_stops_growth():
+    controller = AIMDController(4, maximum=100, latency_factor=2)
+    run(controller, 1.0, BASELINE_REQUESTS)
+    assert controller.target() == 2.0
+    grown = controller.limit
+    assert grown > 4
+    # Smoothed latency climbs past twice the baseline, after which the limit holds
+    run(controller, 10.0, 50)
+    held = controller.limit
+    run(controller, 10.0, 50)
+    assert controller.limit == held
+    assert controller.target() == 2.0
+
+
+def test_throttle_halves_limit():
+    controller = AIMDController(8, maximum=100)
+    controller.acquire()
+    controller.release(1.0, throttled=True)
+    assert controller.limit == 4
@@ -0,0 +1,127 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Offline tests of copy_disk_to_prestaging_bucket() against a fake storage client
+
+import time
+import hashlib
+import threading
+from base64 import b64encode
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip('google.cloud.storage')
+from google.api_core.exceptions import NotFound, ServiceUnavailable
+from ingestion.utilities import utils
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.md5_hash = None
+        self.size = None
+
+    def upload_from_filename(self, filename, checksum=None):
+        with self.bucket.lock:
+            self.bucket.in_flight += 1
+            self.bucket.max_in_flight = max(self.bucket.max_in_flight, self.bucket.in_flight)
+        try:
+            # Give other uploads a chance to overlap this one
+            time.sleep(0.01)
+            if self.name in self.bucket.fail:
+                raise ServiceUnavailable(f'Upload of {self.name} failed')
+            with open(filename, 'rb') as f:
+                data = f.read()
+            data = self.bucket.corrupt.get(self.name, data)
+            self.md5_hash = b64encode(hashlib.md5(data).digest()).decode()
+            self.size = len(data)
+            with self.bucket.lock:
+                self.bucket.blobs[self.name] = data
+        finally:
+            with self.bucket.lock:
+                self.bucket.in_flight -= 1
+
+    def reload(self):
+        data = self.bucket.blobs[self.name]
+        self.md5_hash = b64encode(hashlib.md5(data).digest()).decode()
+        self.size = len(data)
+
+    def delete(self):
+        with self.bucket.lock:
+            if self.name not in self.bucket.blobs:
+                raise NotFound(self.name)
+            del self.bucket.blobs[self.name]
+
+
+class FakeBucket:
+    def __init__(self, fail=(), corrupt=None):
+        self.blobs = {}
+        self.fail = set(fail)
+        # Data that a blob is stored as instead of the uploaded data, by blob name
+        self.corrupt = corrupt or {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeClient:
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def bucket(self, name):
+        return self._bucket
+
+
+# Write a series of instances to disk as the ingestion would, and return its args and series
+def make_series(tmp_path, count=32):
+    series = SimpleNamespace(uuid='series-uuid', series_instance_uid='1.2.3', instances=[])
+    (tmp_path / series.uuid).mkdir()
+    for i in range(count):
+        data = f'instance {i}'.encode() * (i + 1)
+        (tmp_path / series.uuid / f'instance-{i}.dcm').write_bytes(data)
+        series.instances.append(SimpleNamespace(uuid=f'instance-{i}', hash=hashlib.md5(data).hexdigest(),
+                                                size=len(data)))
+    args = SimpleNamespace(pid=1, dicom_dir=str(tmp_path), prestaging_tcia_bucket='prestaging',
+                           gcs_audit_rate=1.0)
+    return args, series
+
+
+def test_uploads_series_concurrently(tmp_path):
+    args, series = make_series(tmp_path)
+    bucket = FakeBucket()
+    utils.copy_disk_to_prestaging_bucket(args, series, FakeClient(bucket))
+    assert set(bucket.blobs) == {f'{series.uuid}/{instance.uuid}.dcm' for instance in series.instances}
+    assert 1 < bucket.max_in_flight <= utils.UPLOAD_THREADS
+
+
+def test_md5_mismatch_fails_and_rolls_back(tmp_path):
+    args, series = make_series(tmp_path)
+    bucket = FakeBucket(corrupt={f'{series.uuid}/instance-3.dcm': b'corrupt'})
+    with pytest.raises(RuntimeError):
+        utils.copy_disk_to_prestaging_bucket(args, series, FakeClient(bucket))
+    assert bucket.blobs == {}
+
+
+def test_upload_failure_rolls_back(tmp_path):
+    args, series = make_series(tmp_path)
+    bucket = FakeBucket(fail={f'{series.uuid}/instance-5.dcm'})
+    with pytest.raises(RuntimeError):
+        utils.copy_disk_to_prestaging_bucket(args, series, FakeClient(bucket))
+    assert bucket.blobs == {}
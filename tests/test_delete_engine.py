@@ -0,0 +1,148 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Offline tests of the delete engine's handling of batch sub-request statuses, against a fake
+# batch that returns scripted statuses
+
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip('google.cloud.storage')
+from utilities import delete_engine
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.blobs = []
+        self._responses = []
+
+    def __enter__(self):
+        self.client.current = self
+        return self
+
+    def __exit__(self, *exc):
+        self.client.current = None
+        self.client.batches.append(len(self.blobs))
+        self._responses = [SimpleNamespace(status_code=self.client.status(blob)) for blob in self.blobs]
+
+
+class FakeBlob:
+    def __init__(self, client, name, generation):
+        self.client = client
+        self.name = name
+        self.generation = generation
+
+    def delete(self):
+        self.client.current.blobs.append((self.name, self.generation))
+
+
+class FakeBucket:
+    def __init__(self, client):
+        self.client = client
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self.client, name, generation)
+
+
+# statuses is a dict of the list of statuses of successive deletes of a blob, by blob name.
+# Blobs that aren't in statuses are deleted with a 204.
+class FakeClient:
+    def __init__(self, statuses):
+        self.statuses = {name: list(s) for name, s in statuses.items()}
+        self.current = None
+        self.batches = []
+        self.attempts = {}
+
+    def batch(self, raise_exception=True):
+        assert raise_exception is False
+        return FakeBatch(self)
+
+    def status(self, blob):
+        name = blob[0]
+        self.attempts[name] = self.attempts.get(name, 0) + 1
+        if name in self.statuses and self.statuses[name]:
+            return self.statuses[name].pop(0)
+        return 204
+
+
+# A DeleteRate that records its signals rather than sleeping
+class FakeRate:
+    def __init__(self):
+        self.throttles = 0
+        self.healthies = 0
+
+    def throttled(self):
+        self.throttles += 1
+
+    def healthy(self):
+        self.healthies += 1
+
+    def wait(self):
+        pass
+
+
+def delete(statuses, count=250):
+    client = FakeClient(statuses)
+    rate = FakeRate()
+    args = SimpleNamespace(id=1, bucket='bucket')
+    blobs = [(f'blob-{i}', i + 1) for i in range(count)]
+    result = delete_engine.delete_blobs(args, client, FakeBucket(client), blobs, 0, rate)
+    return result, client, rate
+
+
+def test_deletes_in_batches_of_delete_batch():
+    result, client, rate = delete({})
+    assert result == {'deleted': 250, 'not_found': 0, 'failed': 0}
+    assert client.batches == [100, 100, 50]
+
+
+def test_not_found_is_already_deleted():
+    result, client, rate = delete({'blob-7': [404]})
+    assert result == {'deleted': 249, 'not_found': 1, 'failed': 0}
+    assert client.attempts['blob-7'] == 1
+
+
+@pytest.mark.parametrize('status', delete_engine.RETRY_STATUSES)
+def test_retryable_statuses_are_retried(status):
+    result, client, rate = delete({'blob-3': [status, status], 'blob-150': [status]})
+    assert result == {'deleted': 250, 'not_found': 0, 'failed': 0}
+    assert client.attempts['blob-3'] == 3
+    assert client.attempts['blob-150'] == 2
+    # Only 429s slow down the worker
+    assert (rate.throttles > 0) == (status == 429)
+
+
+def test_retryable_status_fails_after_tries():
+    result, client, rate = delete({'blob-3': [503] * delete_engine.TRIES})
+    assert result == {'deleted': 249, 'not_found': 0, 'failed': 1}
+    assert client.attempts['blob-3'] == delete_engine.TRIES
+
+
+def test_other_statuses_fail_without_retry():
+    result, client, rate = delete({'blob-3': [403], 'blob-4': [412]})
+    assert result == {'deleted': 248, 'not_found': 0, 'failed': 2}
+    assert client.attempts['blob-3'] == 1
+    assert client.attempts['blob-4'] == 1
+
+
+def test_success_is_logged_only_without_failures(monkeypatch):
+    logged = []
+    monkeypatch.setattr(delete_engine.successlogger, 'info', lambda *args: logged.append(args))
+    delete({'blob-3': [403]})
+    assert logged == []
+    delete({})
+    assert len(logged) == 1
@@ -0,0 +1,121 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Concurrent listing of a bucket.
+# IDC blob names begin with a (series or instance) UUID, so the names are uniformly distributed
+# over the hex keyspace. list_bucket() splits the keyspace into shards of [start_offset, end_offset)
+# ranges, lists the shards concurrently in threads, and streams the pages of the listing to its
+# caller as they arrive. The first and last shards are open ended, so names outside of the hex
+# keyspace are also listed.
+# Each shard's listing is lexicographic. With ordered=True, the pages are yielded in shard order,
+# so the whole listing is lexicographic; later shards are listed ahead while earlier shards are
+# being consumed, up to SHARD_PAGES pages each.
+
+import threading
+from queue import Queue, Full
+from google.cloud import storage
+
+LIST_SHARDS = 16
+# Maximum number of pages of a shard that are listed ahead of the consumer
+SHARD_PAGES = 16
+HEX_DIGITS = 2 # Number of hex digits in shard boundaries; allows up to 256 shards
+
+
+# Return the (start_offset, end_offset) ranges of shards of the hex keyspace
+def shard_ranges(shards, prefix=''):
+    shards = max(1, min(shards, 16**HEX_DIGITS))
+    boundaries = [f'{prefix}{(i * 16**HEX_DIGITS) // shards:0{HEX_DIGITS}x}' for i in range(1, shards)]
+    starts = [prefix or None] + boundaries
+    ends = boundaries + [None]
+    return list(zip(starts, ends))
+
+
+class ShardLister(threading.Thread):
+    def __init__(self, client, bucket_name, start_offset, end_offset, queue, page_size, versions, prefix, delimiter):
+        super().__init__(daemon=True)
+        self.client = client
+        self.bucket_name = bucket_name
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+        self.queue = queue
+        self.page_size = page_size
+        self.versions = versions
+        self.prefix = prefix
+        self.delimiter = delimiter
+        self.stopped = False
+
+    # Put an item in the queue, giving up if the consumer has stopped
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def run(self):
+        try:
+            iterator = self.client.list_blobs(self.bucket_name, versions=self.versions, page_size=self.page_size,
+                prefix=self.prefix or None, delimiter=self.delimiter, start_offset=self.start_offset,
+                end_offset=self.end_offset)
+            for page in iterator.pages:
+                if self.stopped:
+                    return
+                # With a delimiter, the page's prefixes are the listing
+                items = list(page.prefixes) if self.delimiter else list(page)
+                if items:
+                    self.put(items)
+            self.put(None)
+        except Exception as exc:
+            self.put(exc)
+
+
+# Generate the pages of the listing of a bucket. A page is a list of blobs or, if there is a
+# delimiter, a list of prefixes.
+def list_bucket(bucket_name, page_size=1000, versions=False, prefix='', delimiter=None, shards=LIST_SHARDS,
+                ordered=False, client=None):
+    if not client:
+        client = storage.Client()
+    ranges = shard_ranges(shards, prefix)
+    if ordered:
+        queues = [Queue(maxsize=SHARD_PAGES) for _ in ranges]
+    else:
+        queues = [Queue(maxsize=SHARD_PAGES * len(ranges))] * len(ranges)
+    listers = [ShardLister(client, bucket_name, start_offset, end_offset, queue, page_size, versions, prefix,
+                           delimiter) for (start_offset, end_offset), queue in zip(ranges, queues)]
+    for lister in listers:
+        lister.start()
+    try:
+        if ordered:
+            for queue in queues:
+                for page in iter(queue.get, None):
+                    if isinstance(page, Exception):
+                        raise page
+                    yield page
+        else:
+            remaining = len(listers)
+            while remaining:
+                page = queues[0].get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+    finally:
+        # If the caller stops early, the listers exit after their current page
+        for lister in listers:
+            lister.stopped = True
@@ -0,0 +1,96 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# An AIMD (additive increase, multiplicative decrease) limit on the number of GCS requests
+# that are in flight across all the threads of all the processes of a job.
+# A request acquire()s a slot and release()s it with its latency and whether it was throttled
+# (a 429 or 503). The limit grows by about one slot per limit's worth of healthy requests, and
+# halves on a throttled request, at most once per DECREASE_INTERVAL so that a burst of 429s
+# from requests that were already in flight counts as one signal. The limit doesn't grow while
+# the smoothed latency exceeds a target. The target is either fixed, or latency_factor times a
+# baseline, the lowest smoothed latency seen once BASELINE_REQUESTS requests have completed.
+# The controller lives in a ConcurrencyManager server process; worker processes are passed
+# a proxy to it, and each thread of a worker gets its own connection to the manager.
+
+import time
+import threading
+from multiprocessing.managers import BaseManager
+
+DECREASE_INTERVAL = 1 # Seconds
+LATENCY_SMOOTHING = 0.1 # Weight of a new latency in the smoothed latency
+BASELINE_REQUESTS = 100 # Number of requests after which the smoothed latency is a baseline
+
+
+class AIMDController:
+    def __init__(self, initial, minimum=1, maximum=None, decrease=0.5, latency_target=None, latency_factor=None):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(max(minimum, min(initial, self.maximum)))
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.latency_factor = latency_factor
+        self.latency = None
+        self.baseline = None
+        self.in_flight = 0
+        self.requests = 0
+        self.throttles = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+            if throttled:
+                self.throttles += 1
+                now = time.time()
+                if now - self.last_decrease >= DECREASE_INTERVAL:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.latency = latency if self.latency is None else \
+                    (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+                if self.requests >= BASELINE_REQUESTS:
+                    self.baseline = self.latency if self.baseline is None else min(self.baseline, self.latency)
+                target = self.target()
+                if target is None or self.latency <= target:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    # The latency above which the limit doesn't grow, or None if there is none (yet)
+    def target(self):
+        if self.latency_target is not None:
+            return self.latency_target
+        if self.latency_factor is None or self.baseline is None:
+            return None
+        return self.latency_factor * self.baseline
+
+    def stats(self):
+        with self.condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'requests': self.requests,
+                    'throttles': self.throttles, 'latency': self.latency, 'latency_target': self.target()}
+
+
+class ConcurrencyManager(BaseManager):
+    pass
+
+ConcurrencyManager.register('AIMDController', AIMDController)
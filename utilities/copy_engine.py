@@ -0,0 +1,216 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A multiprocess, multithreaded GCS to GCS blob copy engine that is shared by the gcs/, gch/
+# and compound_objects/ copy scripts.
+# A script supplies an iterator of (src_url, dst_url) pairs of gs:// URLs. The pairs are
+# distributed in batches of args.batch to args.processes worker processes, each of which
+# copies a batch with args.threads concurrent rewrites through one storage client.
+# Rewrites that fail with a 429 or 5xx are retried with exponential backoff; a rewrite resumes
+# from its last rewrite token.
+# The key of each copied blob (by default its source blob name) is logged to the successlogger,
+# so that a rerun can skip it by passing the previously copied keys as dones (see get_dones()).
+# dones can be any container of keys; get_dones() returns a compact DoneSet that worker
+# processes share rather than each holding a copy of a set of names.
+# The number of rewrites in flight across all processes is set by an AIMD controller (see
+# utilities/concurrency.py). It starts at args.processes x args.threads, backs off on 429s and
+# 503s, and grows up to args.processes x MAX_THREADS while rewrites are healthy: not throttled,
+# and with a smoothed latency of at most args.latency_target seconds if args has one, else at
+# most LATENCY_FACTOR times the baseline latency that the controller measures.
+
+import time
+import random
+from multiprocessing import Process, Queue
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import storage
+from google.api_core.exceptions import TooManyRequests, ServiceUnavailable, InternalServerError, \
+    BadGateway, GatewayTimeout
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.done_set import DoneSet
+from utilities.concurrency import ConcurrencyManager
+from utilities.delete_engine import get_result
+
+COPY_THREADS = 16
+# Maximum number of concurrent rewrites per process that the controller can grow to
+MAX_THREADS = 64
+COPY_BATCH = 1000
+TRIES = 8
+BACKOFF_BASE = 1 # Seconds
+BACKOFF_MAX = 64 # Seconds
+RETRYABLE = (TooManyRequests, ServiceUnavailable, InternalServerError, BadGateway, GatewayTimeout, ConnectionError,
+             RequestsConnectionError)
+THROTTLED = (TooManyRequests, ServiceUnavailable)
+# The controller stops growing the limit when the smoothed rewrite latency exceeds this multiple of its baseline
+LATENCY_FACTOR = 2
+
+
+# Split a gs:// URL into a bucket name and a blob name
+def split_url(url):
+    bucket_name, blob_name = url.split('gs://')[1].split('/', 1)
+    return bucket_name, blob_name
+
+
+# Keys by which copied blobs are logged and skipped
+def src_blob_name(src_url, dst_url):
+    return split_url(src_url)[1]
+
+
+def dst_blob_name(src_url, dst_url):
+    return split_url(dst_url)[1]
+
+
+# Get the keys of previously copied blobs from the success log
+def get_dones():
+    return DoneSet.from_log(successlogger.handlers[0].baseFilename)
+
+
+def backoff(attempt):
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt) * random.uniform(0.5, 1)
+
+
+# Copy a blob. Returns the number of bytes copied.
+def rewrite_blob(args, client, src_url, dst_url, controller):
+    src_bucket_name, src_name = split_url(src_url)
+    dst_bucket_name, dst_name = split_url(dst_url)
+    src_blob = client.bucket(src_bucket_name).blob(src_name)
+    dst_blob = client.bucket(dst_bucket_name).blob(dst_name)
+    rewrite_token = None
+    attempt = 0
+    while True:
+        controller.acquire()
+        strt = time.time()
+        try:
+            rewrite_token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob, token=rewrite_token)
+        except Exception as exc:
+            controller.release(time.time() - strt, isinstance(exc, THROTTLED))
+            if not isinstance(exc, RETRYABLE):
+                raise
+            attempt += 1
+            if attempt == TRIES:
+                raise
+            delay = backoff(attempt)
+            progresslogger.info('p%s: Retrying %s in %.1fs: %s', args.id, src_url, delay, exc)
+            time.sleep(delay)
+            continue
+        controller.release(time.time() - strt)
+        if not rewrite_token:
+            return total_bytes
+
+
+def copy_pair(args, client, src_url, dst_url, key, controller):
+    try:
+        size = rewrite_blob(args, client, src_url, dst_url, controller)
+        successlogger.info('%s', key(src_url, dst_url))
+        return size
+    except Exception as exc:
+        errlogger.error('p%s: %s --> %s copy failed: %s', args.id, src_url, dst_url, exc)
+        return None
+
+
+def copy_batch(args, client, executor, pairs, n, dones, key, controller):
+    todo = [(src_url, dst_url) for src_url, dst_url in pairs if key(src_url, dst_url) not in dones]
+    sizes = list(executor.map(lambda pair: copy_pair(args, client, *pair, key, controller), todo))
+    copied = [size for size in sizes if size is not None]
+    stats = {'copied': len(copied), 'skipped': len(pairs) - len(todo), 'failed': len(sizes) - len(copied),
+             'bytes': sum(copied)}
+    progresslogger.info('p%s: Blobs %s:%s, copied: %s, skipped: %s, failed: %s', args.id, n, n + len(pairs) - 1,
+                        stats['copied'], stats['skipped'], stats['failed'])
+    return stats
+
+
+def worker(input, output, args, dones, key, controller):
+    client = storage.Client()
+    # The controller, not the pool, limits the number of rewrites in flight
+    with ThreadPoolExecutor(max_workers=max(int(args.threads), MAX_THREADS)) as executor:
+        for pairs, n in iter(input.get, 'STOP'):
+            try:
+                output.put(copy_batch(args, client, executor, pairs, n, dones, key, controller))
+            except Exception as exc:
+                errlogger.error('p%s: Blobs %s:%s failed: %s', args.id, n, n + len(pairs) - 1, exc)
+                output.put({'copied': 0, 'skipped': 0, 'failed': len(pairs), 'bytes': 0})
+
+
+# Copy the (src_url, dst_url) pairs of an iterator.
+# args must have processes, threads and batch components; args.id is set to the id of each process.
+# Returns the totals of copied, skipped and failed blobs, and bytes copied.
+def copy_blobs(args, pairs, dones=None, key=src_blob_name):
+    dones = dones if dones is not None else set()
+    num_processes = int(args.processes)
+    batch = int(args.batch)
+    task_queue = Queue()
+    result_queue = Queue()
+    processes = []
+    strt = time.time()
+
+    manager = ConcurrencyManager()
+    manager.start()
+    controller = manager.AIMDController(num_processes * int(args.threads), minimum=num_processes,
+                                        maximum=num_processes * max(int(args.threads), MAX_THREADS),
+                                        latency_target=getattr(args, 'latency_target', None),
+                                        latency_factor=LATENCY_FACTOR)
+
+    # Start worker processes
+    for process in range(num_processes):
+        args.id = process + 1
+        processes.append(
+            Process(group=None, target=worker, args=(task_queue, result_queue, args, dones, key, controller)))
+        processes[-1].start()
+    args.id = 0
+
+    # Distribute the work across the processes
+    n = 0
+    batches = 0
+    pending = []
+    for pair in pairs:
+        pending.append(pair)
+        if len(pending) == batch:
+            task_queue.put((pending, n))
+            n += len(pending)
+            batches += 1
+            pending = []
+    if pending:
+        task_queue.put((pending, n))
+        n += len(pending)
+        batches += 1
+    progresslogger.info('Primary work distribution complete; %s blobs', n)
+
+    # Tell child processes to stop
+    for process in processes:
+        task_queue.put('STOP')
+
+    totals = {'copied': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    try:
+        for _ in range(batches):
+            for k, v in get_result(result_queue, processes).items():
+                totals[k] += v
+    except RuntimeError:
+        manager.shutdown()
+        raise
+
+    # Wait for process to terminate
+    for process in processes:
+        process.join()
+
+    stats = controller.stats()
+    manager.shutdown()
+
+    delta = time.time() - strt
+    progresslogger.info('Copied %s blobs, %.2f GB, skipped %s, failed %s in %.0fs: %.1f blobs/s, %.2f MB/s, %s processes, final concurrency %s, %s of %s rewrites throttled',
+                        totals['copied'], totals['bytes']/2**30, totals['skipped'], totals['failed'], delta,
+                        totals['copied']/delta, totals['bytes']/2**20/delta, num_processes, stats['limit'],
+                        stats['throttles'], stats['requests'])
+    return totals
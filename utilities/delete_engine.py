@@ -0,0 +1,184 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A multiprocess engine that deletes the blobs of a bucket with GCS JSON API batch requests.
+# The bucket is listed with a sharded, streamed listing (see utilities/bucket_listing.py), and
+# pages of (name, generation) pairs are distributed to args.processes worker processes.
+# A worker deletes its blobs in batches of DELETE_BATCH (the API maximum of 100) delete
+# operations. Each delete names the listed generation, so a versioned bucket's noncurrent
+# generations are deleted, and a generation that was written after the listing is not.
+# The status of each sub-request of a batch is checked: a 404 means the generation is already
+# gone, and a 429 or 5xx is retried in a later batch. A worker paces its batches with an AIMD
+# pause: 429s double the pause, and each batch without them shortens it by PAUSE_STEP.
+
+import time
+from queue import Empty
+from multiprocessing import Process, Queue
+from google.cloud import storage
+from utilities.logging_config import successlogger, progresslogger, errlogger
+from utilities.bucket_listing import list_bucket
+
+DELETE_BATCH = 100
+TRIES = 8
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+PAUSE_MIN = 0.5 # Seconds
+PAUSE_MAX = 32 # Seconds
+PAUSE_STEP = 0.1 # Seconds
+# Seconds to wait for a result before checking that the workers are alive
+WORKER_CHECK_INTERVAL = 60
+
+
+class DeleteRate:
+    def __init__(self):
+        self.pause = 0.0
+
+    def throttled(self):
+        self.pause = min(PAUSE_MAX, max(PAUSE_MIN, self.pause * 2))
+
+    def healthy(self):
+        self.pause = max(0.0, self.pause - PAUSE_STEP)
+
+    def wait(self):
+        if self.pause:
+            time.sleep(self.pause)
+
+
+# Delete a batch of (name, generation) blobs in one batch request.
+# Returns the statuses of the sub-requests.
+def delete_batch(client, bucket, blobs):
+    # The batch doesn't raise on failed sub-requests, and keeps their responses in _responses.
+    # Both require google-cloud-storage >= 2.10.0; see requirements.txt.
+    with client.batch(raise_exception=False) as batch:
+        for name, generation in blobs:
+            bucket.blob(name, generation=generation).delete()
+    return [response.status_code for response in batch._responses]
+
+
+# Delete blobs, retrying the sub-requests that fail with a retryable status.
+# Returns the number of blobs deleted, already deleted and failed.
+def delete_blobs(args, client, bucket, blobs, n, rate):
+    deleted = not_found = failed = 0
+    todo = list(blobs)
+    for attempt in range(TRIES):
+        retry = []
+        for i in range(0, len(todo), DELETE_BATCH):
+            batch = todo[i:i + DELETE_BATCH]
+            rate.wait()
+            try:
+                statuses = delete_batch(client, bucket, batch)
+            except Exception as exc:
+                # The batch request itself failed
+                progresslogger.info('p%s: Delete batch of %s blobs %s:%s failed: %s', args.id, args.bucket, n,
+                                    n + len(blobs) - 1, exc)
+                rate.throttled()
+                retry.extend(batch)
+                continue
+            throttled = False
+            for blob, status in zip(batch, statuses):
+                if 200 <= status < 300:
+                    deleted += 1
+                elif status == 404:
+                    not_found += 1
+                elif status in RETRY_STATUSES:
+                    throttled |= status == 429
+                    retry.append(blob)
+                else:
+                    errlogger.error('p%s: Delete %s/%s#%s failed: %s', args.id, args.bucket, blob[0], blob[1], status)
+                    failed += 1
+            if throttled:
+                rate.throttled()
+            else:
+                rate.healthy()
+        todo = retry
+        if not todo:
+            break
+    for name, generation in todo:
+        errlogger.error('p%s: Delete %s/%s#%s failed after %s tries', args.id, args.bucket, name, generation, TRIES)
+    failed += len(todo)
+    if not failed:
+        successlogger.info('p%s Delete %s blobs %s:%s ', args.id, args.bucket, n, n + len(blobs) - 1)
+    return {'deleted': deleted, 'not_found': not_found, 'failed': failed}
+
+
+def worker(input, output, args):
+    client = storage.Client()
+    bucket = storage.Bucket(client, args.bucket)
+    rate = DeleteRate()
+    for blobs, n in iter(input.get, 'STOP'):
+        output.put(delete_blobs(args, client, bucket, blobs, n, rate))
+
+
+# Get the result of a batch. If a worker has died, the batch that it was working on will never
+# have a result, so the workers are terminated and a RuntimeError is raised. Also used by
+# utilities/copy_engine.py.
+def get_result(result_queue, processes):
+    while True:
+        try:
+            return result_queue.get(True, WORKER_CHECK_INTERVAL)
+        except Empty:
+            dead = [process.pid for process in processes if not process.is_alive()]
+            if dead:
+                errlogger.error('Worker processes %s died', dead)
+                for process in processes:
+                    process.terminate()
+                    process.join()
+                raise RuntimeError(f'Worker processes {dead} died')
+
+
+# Delete all the blobs, including noncurrent generations, in args.bucket.
+# args must have bucket, processes and batch components.
+def delete_all_blobs(args):
+    num_processes = int(args.processes)
+    processes = []
+    task_queue = Queue()
+    result_queue = Queue()
+    strt = time.time()
+
+    # Start worker processes
+    for process in range(num_processes):
+        args.id = process + 1
+        processes.append(
+            Process(group=None, target=worker, args=(task_queue, result_queue, args)))
+        processes[-1].start()
+    args.id = 0
+
+    # Distribute the work across the processes
+    n = 0
+    batches = 0
+    for page in list_bucket(args.bucket, page_size=int(args.batch), versions=True):
+        blobs = [(blob.name, blob.generation) for blob in page]
+        task_queue.put((blobs, n))
+        n += len(blobs)
+        batches += 1
+    progresslogger.info('Primary work distribution complete; {} blobs'.format(n))
+
+    # Tell child processes to stop
+    for process in processes:
+        task_queue.put('STOP')
+
+    totals = {'deleted': 0, 'not_found': 0, 'failed': 0}
+    for _ in range(batches):
+        for k, v in get_result(result_queue, processes).items():
+            totals[k] += v
+
+    # Wait for process to terminate
+    for process in processes:
+        process.join()
+
+    delta = time.time() - strt
+    progresslogger.info(f'Completed bucket {args.bucket}: deleted {totals["deleted"]}, already deleted {totals["not_found"]}, '
+                        f'failed {totals["failed"]}, {n/delta:.1f} blobs/sec, {num_processes} processes')
+    return totals
@@ -0,0 +1,136 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A compact, read only set of the keys (e.g. blob names) that a previous run of a copy or
+# validation job completed, as logged one per line in a log such as success.log.
+# The set is a file of the sorted, distinct 128-bit md5 digests of the keys, which is mmap'd
+# and binary searched. A DoneSet pickles as just its path, so passing it to a worker
+# process doesn't copy the keys; each process maps the file, and the page cache is shared.
+# The sorted file is built with an external merge sort, so building it doesn't hold the
+# keys in memory either.
+
+import os
+import mmap
+import heapq
+import hashlib
+import tempfile
+
+DIGEST_SIZE = 16
+# Number of digests sorted in memory per run of the external sort
+RUN_SIZE = 1000000
+
+
+def digest(key):
+    return hashlib.md5(key.encode()).digest()
+
+
+def read_digests(path):
+    with open(path, 'rb') as f:
+        while True:
+            d = f.read(DIGEST_SIZE)
+            if not d:
+                return
+            yield d
+
+
+class DoneSet:
+    def __init__(self, path):
+        self.path = path
+        self.count = os.path.getsize(path) // DIGEST_SIZE
+        self.mm = None
+        self.pid = None
+
+    # Build the DoneSet of the keys of an iterable at path
+    @classmethod
+    def build(cls, keys, path):
+        runs = []
+        directory = os.path.dirname(path) or '.'
+        try:
+            digests = []
+            for key in keys:
+                digests.append(digest(key))
+                if len(digests) == RUN_SIZE:
+                    runs.append(cls.write_run(digests, directory))
+                    digests = []
+            if digests or not runs:
+                runs.append(cls.write_run(digests, directory))
+            # Merge the sorted runs, dropping duplicates
+            with open(f'{path}.tmp', 'wb') as f:
+                previous = None
+                for d in heapq.merge(*[read_digests(run) for run in runs]):
+                    if d != previous:
+                        f.write(d)
+                        previous = d
+            os.replace(f'{path}.tmp', path)
+        finally:
+            for run in runs:
+                os.remove(run)
+        return cls(path)
+
+    @staticmethod
+    def write_run(digests, directory):
+        digests.sort()
+        fd, run = tempfile.mkstemp(dir=directory, suffix='.run')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b''.join(digests))
+        return run
+
+    # Build the DoneSet of the lines of a log file. The DoneSet is written next to the log.
+    @classmethod
+    def from_log(cls, log_path):
+        try:
+            with open(log_path) as f:
+                return cls.build((line.rstrip('\n') for line in f), f'{log_path}.dones')
+        except FileNotFoundError:
+            return cls.build([], f'{log_path}.dones')
+
+    def map(self):
+        if self.pid != os.getpid():
+            self.mm = None
+            if self.count:
+                with open(self.path, 'rb') as f:
+                    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.pid = os.getpid()
+        return self.mm
+
+    def __contains__(self, key):
+        mm = self.map()
+        if mm is None:
+            return False
+        d = digest(key)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = mm[mid * DIGEST_SIZE:(mid + 1) * DIGEST_SIZE]
+            if entry < d:
+                lo = mid + 1
+            elif entry > d:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        return {'path': self.path, 'count': self.count}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.count = state['count']
+        self.mm = None
+        self.pid = None
@@ -0,0 +1,130 @@
+#
+# Copyright 2015-2021, Institute for Systems Biology
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A persistent cache of NBIA listing responses (patients per collection, studies per patient,
+# etc.). When an ingestion is restarted, the listings that it already made are replayed from
+# the cache instead of being requested again from NBIA.
+# Entries are indexed by a hash of the listing function and its arguments, and expire after
+# a TTL. The cache is only used by a process that has called enable_listing_cache().
+#
+# To invalidate entries:
+#   python utilities/nbia_cache.py [--cache <path>] [--collections <collection_id> ...] [--expired_only True]
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from functools import wraps
+
+import settings
+
+NBIA_CACHE = f'/mnt/disks/idc-etl/nbia_cache/v{settings.CURRENT_VERSION}.sqlite'
+NBIA_CACHE_TTL = 24*60*60 # Seconds
+
+
+class NBIACache:
+    def __init__(self, path=NBIA_CACHE, ttl=NBIA_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # sqlite3 connections can't be shared across threads or forked processes
+        self.local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS listings '
+            '(key TEXT PRIMARY KEY, listing TEXT, collection_id TEXT, timestamp REAL, response TEXT)')
+
+    def connection(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            # WAL lets the worker processes read while one of them writes
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    @staticmethod
+    def key(listing, call):
+        return hashlib.sha256(json.dumps([listing, call], sort_keys=True).encode()).hexdigest()
+
+    # Return the cached response of a listing, or None if there isn't an unexpired one
+    def get(self, listing, call):
+        row = self.connection().execute('SELECT timestamp, response FROM listings WHERE key = ?',
+            (self.key(listing, call),)).fetchone()
+        if row and time.time() - row[0] < self.ttl:
+            self.hits += 1
+            return json.loads(row[1])
+        self.misses += 1
+        return None
+
+    def put(self, listing, collection_id, call, response):
+        self.connection().execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+            (self.key(listing, call), listing, collection_id, time.time(), json.dumps(response)))
+
+    # Delete the entries of some or all collections. Returns the number of entries deleted.
+    def invalidate(self, collection_ids=None, expired_only=False):
+        query = 'DELETE FROM listings WHERE 1 = 1'
+        params = []
+        if collection_ids:
+            query += f' AND collection_id IN ({",".join("?" * len(collection_ids))})'
+            params.extend(collection_ids)
+        if expired_only:
+            query += ' AND timestamp <= ?'
+            params.append(time.time() - self.ttl)
+        return self.connection().execute(query, params).rowcount
+
+
+listing_cache = None
+def enable_listing_cache(path=NBIA_CACHE, ttl=NBIA_CACHE_TTL):
+    global listing_cache
+    listing_cache = NBIACache(path, ttl)
+    return listing_cache
+
+
+# Decorator of a listing function whose first argument is a collection_id.
+# Empty responses are not cached because NBIA sometimes returns an empty response on a transient failure.
+def cached_listing(func):
+    @wraps(func)
+    def wrapper(collection_id, *args, **kwargs):
+        if listing_cache is None:
+            return func(collection_id, *args, **kwargs)
+        call = [collection_id, list(args), kwargs]
+        response = listing_cache.get(func.__name__, call)
+        if response is None:
+            response = func(collection_id, *args, **kwargs)
+            if response:
+                listing_cache.put(func.__name__, collection_id, call, response)
+        return response
+    return wrapper
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--cache', default=NBIA_CACHE, help='Path of the NBIA listing cache')
+    parser.add_argument('--ttl', type=int, default=NBIA_CACHE_TTL, help='Seconds after which a cached listing expires')
+    parser.add_argument('--collections', nargs='*', default=[], help='Collections whose listings are invalidated. All if empty')
+    parser.add_argument('--expired_only', type=bool, default=False, help='Only delete expired listings')
+    args = parser.parse_args()
+    print("{}".format(args), file=sys.stdout)
+
+    deleted = NBIACache(args.cache, args.ttl).invalidate(args.collections, args.expired_only)
+    print(f'Deleted {deleted} cached listings')
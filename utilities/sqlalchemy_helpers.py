@@ -14,10 +14,11 @@
 # limitations under the License.
 #
 
+import os
 import settings
 from sqlalchemy import create_engine
 from sqlalchemy_utils import register_composites
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from idc.models import Base
 
 # Create an SQLAlchemy session
@@ -33,3 +34,46 @@ def sa_session(echo=False):
 
     return sess
 
+
+# Maximum number of pooled connections of the engine of sa_engine()
+ENGINE_POOL_SIZE = 16
+_engine = None
+_engine_pid = None
+
+# Get an SQLAlchemy engine that is shared by the threads of a process, e.g. to create a
+# Session(sa_engine()) per thread. The engine, and its connection pool, is created once per
+# process, so that a forked child doesn't use its parent's connections.
+def sa_engine(echo=False):
+    global _engine, _engine_pid
+    if _engine_pid != os.getpid():
+        sql_uri = f'postgresql+psycopg2://{settings.CLOUD_USERNAME}:{settings.CLOUD_PASSWORD}@{settings.CLOUD_HOST}:{settings.CLOUD_PORT}/{settings.CLOUD_DATABASE}'
+        _engine = create_engine(sql_uri, echo=echo, pool_size=ENGINE_POOL_SIZE, max_overflow=0)
+        # Enable the underlying psycopg2 to deal with composites
+        with _engine.connect() as conn:
+            register_composites(conn)
+        _engine_pid = os.getpid()
+    return _engine
+
+
+
+# The levels, top down, of the collection->patient->study->series->instance hierarchy, and the
+# relationship from each level to its children. The versioned (Collection, Patient, ...) and the
+# idc_* (IDC_Collection, IDC_Patient, ...) models use the same table and relationship names.
+LEVELS = ['collection', 'patient', 'study', 'series', 'instance']
+HIERARCHY = ['patients', 'studies', 'seriess', 'instances']
+
+# Return a loader option that eagerly loads the hierarchy below objects of some model, down to
+# levels levels, e.g. sess.query(Collection).options(eager_hierarchy(Collection)).
+# Each level is loaded with one SELECT ... WHERE parent IN (...) per batch of parents, rather
+# than a lazy SELECT per parent when the walk first touches a relationship.
+# Note that a session that expires on commit discards what was loaded; a walker that commits
+# as it goes should use a Session(..., expire_on_commit=False).
+def eager_hierarchy(model, levels=len(HIERARCHY)):
+    level = LEVELS.index(model.__tablename__.removeprefix('idc_'))
+    names = HIERARCHY[level:level + levels]
+    option = None
+    for name in names:
+        relationship = getattr(model, name)
+        option = selectinload(relationship) if option is None else option.selectinload(relationship)
+        model = relationship.property.mapper.class_
+    return option
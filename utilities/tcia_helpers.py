@@ -24,6 +24,12 @@ import requests
 import logging
 import pandas as pd
 import zipfile
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import tempfile
+import hashlib
 
 # from http.client import HTTPConnection
 # HTTPConnection.debuglevel = 0
@@ -36,11 +42,17 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 # from python_settings import settings
 import settings
 import logging
+from utilities.nbia_cache import cached_listing
 logging.getLogger("requests").setLevel(logging.WARNING)
 
 
 TIMEOUT=60
 CHUNK_SIZE=1024*1024
+# Zips of streamed series, and the instances read from them, are held in memory up to this
+# size, then spill to a temp file
+SPOOL_SIZE=32*1024*1024
+# Maximum number of keep-alive connections per NBIA host
+POOL_SIZE=16
 
 TCIA_URL = 'https://services.cancerimagingarchive.net/services/v4/TCIA/query'
 NBIA_URL = 'https://services.cancerimagingarchive.net/nbia-api/services'
@@ -65,7 +77,8 @@ def get_url(url, headers="", timeout=TIMEOUT):  # , headers):
         raise RuntimeError('In get_url(): status_code=%s; url: %s', result.status_code, url)
     return result
 
-def get_access_token(auth_server = NBIA_AUTH_URL):
+# Form data of an access token request to some auth server
+def get_access_token_data(auth_server = NBIA_AUTH_URL):
     if auth_server == NLST_AUTH_URL:
         data = dict(
             username=settings.TCIA_ID,
@@ -80,11 +93,136 @@ def get_access_token(auth_server = NBIA_AUTH_URL):
             client_id=settings.TCIA_CLIENT_ID,
             client_secret=settings.TCIA_CLIENT_SECRET,
             grant_type="password")
+    return data
+
 
+def get_access_token(auth_server = NBIA_AUTH_URL):
+    data = get_access_token_data(auth_server)
     result = requests.post(auth_server, data = data)
     return (result.json()['access_token'], result.json()['refresh_token'])
 
 
+# A client of the NBIA API. The client holds a keep-alive requests.Session, so that
+# requests reuse connections, and retries requests that fail with a transient error
+# with exponential backoff. It caches its access token, which is shared by all threads
+# using the client. The token is fetched again shortly before it expires, or if NBIA
+# refuses it.
+class NBIAClient:
+    def __init__(self, server="NBIA", retries=4, backoff_factor=1, token_margin=60, timeout=TIMEOUT):
+        if server == "NLST":
+            self.server_url = NLST_URL
+            self.v2_server_url = NLST_V2_URL
+            self.auth_url = NLST_AUTH_URL
+        else:
+            self.server_url = NBIA_URL
+            self.v2_server_url = NBIA_V2_URL
+            self.auth_url = NBIA_AUTH_URL
+        self.timeout = timeout
+        # Seconds before the token expires at which we get a new one
+        self.token_margin = token_margin
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'POST']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.expires_at = 0
+        self.licenses = None
+
+    # Get a valid access token, fetching a new one if we don't have one or it is about to expire
+    def get_access_token(self):
+        with self.lock:
+            if not self.access_token or time.time() >= self.expires_at - self.token_margin:
+                result = self.session.post(self.auth_url, data=get_access_token_data(self.auth_url), timeout=self.timeout)
+                result.raise_for_status()
+                token = result.json()
+                self.access_token = token['access_token']
+                self.expires_at = time.time() + token.get('expires_in', 3600)
+            return self.access_token
+
+    # Discard a token that NBIA refused, unless another thread already replaced it
+    def invalidate_access_token(self, access_token):
+        with self.lock:
+            if self.access_token == access_token:
+                self.access_token = None
+
+    def request(self, method, url, authorize=True, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if not authorize:
+            return self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+        access_token = self.get_access_token()
+        headers['Authorization'] = f'Bearer {access_token}'
+        result = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+        if result.status_code == 401:
+            # Get a new token and try once more
+            self.invalidate_access_token(access_token)
+            headers['Authorization'] = f'Bearer {self.get_access_token()}'
+            result = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+        return result
+
+    def get_hash(self, request_data):
+        return self.request('POST', f"{self.server_url}/getMD5Hierarchy", data=request_data)
+
+    def get_instance_hash(self, sop_instance_uid):
+        return self.request('GET', f"{self.v2_server_url}/getM5HashForImage?SOPInstanceUid={sop_instance_uid}")
+
+    # Get NBIAs internal ID for all the series in a collection/patient
+    def get_internal_series_ids(self, collection, patient, third_party="yes", size=100000):
+        data = dict(
+            criteriaType0="ThirdPartyAnalysis",
+            value0=third_party,
+            criteriaType1="CollectionCriteria",
+            value1=collection)
+        if not patient=="":
+            data |= dict(
+                criteriaType2="PatientCriteria",
+                value2=patient)
+        data |= dict(
+            sortField="subject",
+            sortDirection="ascending",
+            start=0,
+            size=size)
+        result = self.request('POST', f'{self.server_url}/getSimpleSearchWithModalityAndBodyPartPaged', data=data)
+        result.raise_for_status()
+        return result.json()
+
+    def series_drill_down(self, series_ids):
+        data = [('list', id) for id in series_ids]
+        result = self.request('POST', f'{self.server_url}/getStudyDrillDown', data=data)
+        result.raise_for_status()
+        return result.json()
+
+    def get_series_metadata(self, seriesInstanceUID):
+        url = f'{NBIA_V1_URL}/getSeriesMetaData?SeriesInstanceUID={seriesInstanceUID}'
+        result = self.request('GET', url, authorize=False)
+        result.raise_for_status()
+        series = result.json() if result.content else {}
+        return series[0]
+
+    # The licenses are fetched once per client
+    def get_license_info(self):
+        if self.licenses is None:
+            result = self.request('GET', 'https://public.cancerimagingarchive.net/nbia-api/services/getLicenses')
+            result.raise_for_status()
+            self.licenses = {license['longName']: license for license in result.json()}
+        return self.licenses
+
+
+# Get this process's client of some NBIA server, creating it if necessary. Clients are not
+# shared across processes because a forked child must not reuse its parent's connections.
+nbia_clients = {}
+def get_nbia_client(server="NBIA"):
+    server = "NLST" if server == "NLST" else "NBIA"
+    key = (server, os.getpid())
+    if not key in nbia_clients:
+        nbia_clients[key] = NBIAClient(server)
+    return nbia_clients[key]
+
+
 # def refresh_access_token(refresh_token, auth_server = NBIA_AUTH_URL):
 #     data = dict(
 #         refresh_token=refresh_token,
@@ -227,6 +365,7 @@ def get_collection_values_and_counts(server=NBIA_URL):
     return collections
 
 
+@cached_listing
 def get_TCIA_patients_per_collection(collection_id, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
@@ -246,6 +385,7 @@ def get_TCIA_patients_per_collection(collection_id, server=NBIA_V1_URL):
     return patients
 
 
+@cached_listing
 def get_TCIA_studies_per_patient(collection_id, patientID, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
@@ -284,6 +424,7 @@ def get_TCIA_studies_per_patient(collection_id, patientID, server=NBIA_V1_URL):
 #     return studies
 
 
+@cached_listing
 def get_TCIA_series_per_study(collection_id, patientID, studyInstanceUID, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
@@ -310,6 +451,7 @@ def get_TCIA_series_metadata(seriesInstanceUID, server=NBIA_V1_URL):
     series = results.json() if results.content else {}
     return series[0]
 
+@cached_listing
 def get_TCIA_instance_uids_per_series(collection_id, seriesInstanceUID, server=NBIA_V1_URL):
     if collection_id == "NLST":
         server_url = NLST_V2_URL
@@ -353,6 +495,46 @@ def get_TCIA_instances_per_series_with_hashes(dicom, series):
 
     return hashes
 
+
+# Stream the instances of a series from NBIA without extracting the zip to disk.
+# The zip is received into a spooled buffer (a zip's directory is at its end, so it
+# cannot be walked before it is fully received), then each member is decompressed once,
+# into another spooled buffer, computing its md5 and size as it is read.
+# Yields (file_name, data, md5, size, expected_md5) per instance, where data is a file object
+# positioned at the start of the instance, that is valid until the next instance is yielded;
+# expected_md5 is the hash that NBIA reported in md5hashes.csv, or None if NBIA did not report one.
+def stream_TCIA_instances_per_series_with_hashes(series, spool_size=SPOOL_SIZE):
+    url = f'{NBIA_V1_URL}/getImageWithMD5Hash?SeriesInstanceUID={series.series_instance_uid}'
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as buffer:
+        with requests.get(url, stream=True, timeout=TIMEOUT) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                buffer.write(chunk)
+        buffer.seek(0)
+
+        with zipfile.ZipFile(buffer, "r") as zip_ref:
+            try:
+                md5hashes = zip_ref.read('md5hashes.csv')
+            except KeyError:
+                raise RuntimeError(f'In stream_TCIA_instances_per_series_with_hashes(): no md5hashes.csv in zip of series {series.series_instance_uid}')
+            hashes = dict(row.split(',', 1) for row in md5hashes.decode().splitlines()[1:])
+            for member in zip_ref.infolist():
+                if member.is_dir() or member.filename == 'md5hashes.csv':
+                    continue
+                md5 = hashlib.md5()
+                size = 0
+                with tempfile.SpooledTemporaryFile(max_size=spool_size) as data:
+                    with zip_ref.open(member) as f:
+                        while True:
+                            chunk = f.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            md5.update(chunk)
+                            size += len(chunk)
+                            data.write(chunk)
+                    data.seek(0)
+                    yield member.filename, data, md5.hexdigest(), size, hashes.get(member.filename)
+
 # # Not used
 # def get_TCIA_instances_per_series(dicom, series_instance_uid, server=NBIA_V1_URL):
 #     filename = "{}/{}.zip".format(dicom, series_instance_uid)
@@ -422,63 +604,11 @@ def get_TCIA_instances_per_series_with_hashes(dicom, series):
 
 # Get NBIAs internal ID for all the series in a collection/patient
 def get_internal_series_ids(collection, patient, third_party="yes", size=100000, server="" ):
-    if server == "NLST":
-        server_url = NLST_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
-    else:
-        server_url = NBIA_URL
-        access_token, refresh_token = get_access_token(NBIA_AUTH_URL)
-    headers = dict(
-        Authorization=f'Bearer {access_token}'
-    )
-    url = f'{server_url}/getSimpleSearchWithModalityAndBodyPartPaged'
-    if not patient=="":
-        data = dict(
-            criteriaType0="ThirdPartyAnalysis",
-            value0=third_party,
-            criteriaType1="CollectionCriteria",
-            value1=collection,
-            criteriaType2="PatientCriteria",
-            value2=patient,
-            sortField="subject",
-            sortDirection="ascending",
-            start=0,
-            size=size)
-    else:
-        data = dict(
-            criteriaType0="ThirdPartyAnalysis",
-            value0=third_party,
-            criteriaType1="CollectionCriteria",
-            value1=collection,
-            sortField="subject",
-            sortDirection="ascending",
-            start=0,
-            size=size)
-
-    result = requests.post(
-        url,
-        headers=headers,
-        data=data
-    )
-    return result.json()
+    return get_nbia_client(server).get_internal_series_ids(collection, patient, third_party, size)
 
 
 def series_drill_down(series_ids, server="" ):
-    if server == "NLST":
-        server_url = NLST_URL
-        access_token, refresh_token = get_access_token(NLST_AUTH_URL)
-    else:
-        server_url = NBIA_URL
-        access_token, refresh_token = get_access_token(NBIA_AUTH_URL)
-    url = f'{server_url}/getStudyDrillDown'
-    data = "&".join(['list={}'.format(id) for id in series_ids])
-
-    try:
-        result = run(['curl', '-v', '-H', "Authorization:Bearer {}".format(access_token), '-k',  url, '-d', data],
-                     stdout=PIPE, stderr=PIPE)
-    except:
-        pass
-    return json.loads(result.stdout.decode())
+    return get_nbia_client(server).series_drill_down(series_ids)
 
 
 def get_collection_descriptions_and_licenses(collection=None):